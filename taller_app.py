@@ -1,10 +1,12 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
-import uuid
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
+import io
+
+from taller_datos import (
+    ESQUEMAS, ESTADOS, FORMATOS_DATOS, HORARIOS_CITA, AlmacenTaller, ConflictoConcurrencia, EstadoCita,
+    HorarioNoDisponible, StockInsuficiente, TransicionInvalida, transicion_valida
+)
 
 # Configuración de la página
 st.set_page_config(
@@ -70,64 +72,22 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Almacén de datos compartido por todas las sesiones del proceso
+@st.cache_resource
+def obtener_almacen():
+    return AlmacenTaller()
+
 # Inicialización de datos en session_state
 def init_session_state():
     if 'authenticated' not in st.session_state:
         st.session_state.authenticated = False
-    
-    if 'clientes' not in st.session_state:
-        st.session_state.clientes = pd.DataFrame({
-            'id': ['CLI001', 'CLI002'],
-            'nombre': ['Juan Pérez', 'María García'],
-            'telefono': ['123456789', '987654321'],
-            'email': ['juan@email.com', 'maria@email.com'],
-            'fecha_registro': [datetime.now().strftime('%Y-%m-%d')] * 2
-        })
-    
-    if 'vehiculos' not in st.session_state:
-        st.session_state.vehiculos = pd.DataFrame({
-            'id': ['VEH001', 'VEH002'],
-            'cliente_id': ['CLI001', 'CLI002'],
-            'marca': ['Toyota', 'Honda'],
-            'modelo': ['Corolla', 'Civic'],
-            'año': [2020, 2019],
-            'placa': ['ABC123', 'XYZ789']
-        })
-    
-    if 'citas' not in st.session_state:
-        st.session_state.citas = pd.DataFrame({
-            'id': ['CIT001', 'CIT002'],
-            'cliente_id': ['CLI001', 'CLI002'],
-            'vehiculo_id': ['VEH001', 'VEH002'],
-            'servicio': ['Cambio de aceite', 'Revisión general'],
-            'fecha': [(datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d'),
-                     (datetime.now() + timedelta(days=2)).strftime('%Y-%m-%d')],
-            'hora': ['10:00', '14:00'],
-            'estado': ['Confirmada', 'Pendiente'],
-            'precio': [50000, 120000]
-        })
-    
-    if 'inventario' not in st.session_state:
-        st.session_state.inventario = pd.DataFrame({
-            'id': ['INV001', 'INV002', 'INV003', 'INV004'],
-            'item': ['Aceite motor 5W-30', 'Filtro aire', 'Pastillas freno', 'Bujías'],
-            'stock': [25, 15, 8, 30],
-            'stock_minimo': [10, 10, 5, 20],
-            'precio': [25000, 35000, 80000, 15000],
-            'proveedor': ['Lubricantes S.A.', 'Filtros Pro', 'Frenos Total', 'Bujías Max']
-        })
-    
-    if 'servicios' not in st.session_state:
-        st.session_state.servicios = [
-            {'nombre': 'Cambio de aceite', 'precio': 50000, 'duracion': '30 min'},
-            {'nombre': 'Revisión general', 'precio': 120000, 'duracion': '2 horas'},
-            {'nombre': 'Alineación y balanceo', 'precio': 80000, 'duracion': '1 hora'},
-            {'nombre': 'Cambio de frenos', 'precio': 150000, 'duracion': '1.5 horas'},
-            {'nombre': 'Diagnóstico computarizado', 'precio': 70000, 'duracion': '45 min'},
-            {'nombre': 'Cambio de filtros', 'precio': 60000, 'duracion': '45 min'}
-        ]
 
 init_session_state()
+almacen = obtener_almacen()
+perfil = almacen.perfilador
+# Con varios procesos detrás de un balanceador, cada ejecución del script
+# trae antes los cambios que hayan hecho los demás
+almacen.sincronizar()
 
 # Funciones de autenticación
 def login():
@@ -145,9 +105,48 @@ def login():
             else:
                 st.error("Credenciales incorrectas")
 
-# Función para generar ID únicos
-def generate_id(prefix):
-    return f"{prefix}{str(uuid.uuid4())[:6].upper()}"
+# Colores del borde de cada cita en el calendario según su estado
+COLORES_ESTADO = {
+    'Confirmada': '#28a745',
+    'Pendiente': '#ffc107',
+    'Completada': '#17a2b8',
+    'Cancelada': '#dc3545'
+}
+
+# Textos de "Mis Citas" construidos por columnas sobre la vista unida
+def texto_citas(vista):
+    return (
+        "**Cliente:** " + vista['cliente_nombre'].astype(str) + "  \n"
+        + "**Vehículo:** " + vista['vehiculo'] + "  \n"
+        + "**Servicio:** " + vista['servicio'].astype(str) + "  \n"
+        + "**Fecha:** " + vista['fecha_texto'] + " - " + vista['hora_texto'] + "  \n"
+        + "**Estado:** " + vista['estado'].astype(str) + "  \n"
+        + "**Precio:** $" + vista['precio'].map('{:,}'.format)
+    )
+
+# Bloques HTML del calendario construidos por columnas sobre la vista unida
+def html_calendario(vista):
+    color = vista['estado'].astype(str).map(COLORES_ESTADO).fillna('#dc3545')
+    return (
+        '<div style="padding: 10px; margin: 5px 0; border-left: 4px solid ' + color
+        + '; background: #f8f9fa;"><strong>' + vista['hora_texto'] + '</strong> - '
+        + vista['cliente_nombre'].astype(str) + '<br>'
+        + '<strong>Servicio:</strong> ' + vista['servicio'].astype(str) + '<br>'
+        + '<strong>Vehículo:</strong> ' + vista['vehiculo'] + '<br>'
+        + '<strong>Estado:</strong> ' + vista['estado'].astype(str)
+        + ' | <strong>Precio:</strong> $' + vista['precio'].map('{:,}'.format)
+        + '</div>'
+    )
+
+# Cambia el estado de una cita y recarga la página; si la transición no
+# está permitida o la cita cambió en otra terminal, muestra el motivo
+def cambiar_estado_cita(cita_id, estado):
+    try:
+        almacen.cambiar_estado(cita_id, estado)
+    except (TransicionInvalida, ConflictoConcurrencia, StockInsuficiente) as error:
+        st.error(str(error))
+    else:
+        st.rerun()
 
 # Pantalla de inicio
 def pantalla_inicio():
@@ -193,7 +192,7 @@ def pantalla_inicio():
     with col2:
         st.markdown("## 🛠️ Nuestros Servicios")
         
-        for servicio in st.session_state.servicios[:4]:
+        for servicio in almacen.catalogo.servicios[:4]:
             st.markdown(f"""
             <div class="service-card">
                 <h4>{servicio['nombre']}</h4>
@@ -210,10 +209,9 @@ def pantalla_inicio():
         # Estadísticas rápidas
         st.markdown("## 📊 Estadísticas")
         
-        total_citas = len(st.session_state.citas)
-        citas_hoy = len(st.session_state.citas[
-            st.session_state.citas['fecha'] == datetime.now().strftime('%Y-%m-%d')
-        ])
+        # Conteos directos: la página de inicio no carga las citas en memoria
+        total_citas = almacen.contar('citas')
+        citas_hoy = almacen.citas_en(datetime.now().strftime('%Y-%m-%d'))
         
         col_stat1, col_stat2 = st.columns(2)
         with col_stat1:
@@ -227,7 +225,7 @@ def modulo_citas():
     
     tabs = st.tabs(["Agendar Cita", "Mis Citas", "Buscar Cliente"])
     
-    with tabs[0]:
+    with tabs[0], perfil.tramo("Agendar Cita"):
         st.markdown("### Agendar Nueva Cita")
         
         col1, col2 = st.columns(2)
@@ -242,11 +240,12 @@ def modulo_citas():
                 telefono = st.text_input("Teléfono")
                 email = st.text_input("Email")
             else:
-                clientes_list = st.session_state.clientes['nombre'].tolist()
-                cliente_seleccionado = st.selectbox("Seleccionar cliente", clientes_list)
-                cliente_data = st.session_state.clientes[
-                    st.session_state.clientes['nombre'] == cliente_seleccionado
-                ].iloc[0]
+                nombres_clientes = almacen.nombres_clientes()
+                cliente_seleccionado = st.selectbox(
+                    "Seleccionar cliente", list(nombres_clientes),
+                    format_func=nombres_clientes.get
+                )
+                cliente_data = almacen.buscar('clientes', cliente_seleccionado)
         
         with col2:
             # Datos del vehículo
@@ -257,9 +256,7 @@ def modulo_citas():
                 año = st.number_input("Año", min_value=1990, max_value=2024, value=2020)
                 placa = st.text_input("Placa")
             else:
-                vehiculos_cliente = st.session_state.vehiculos[
-                    st.session_state.vehiculos['cliente_id'] == cliente_data['id']
-                ]
+                vehiculos_cliente = almacen.filas_por('vehiculos', 'cliente_id', cliente_data['id'])
                 if len(vehiculos_cliente) > 0:
                     vehiculo_info = vehiculos_cliente.iloc[0]
                     st.text_input("Marca", value=vehiculo_info['marca'], disabled=True)
@@ -271,80 +268,85 @@ def modulo_citas():
         col3, col4 = st.columns(2)
         
         with col3:
-            servicios_nombres = [s['nombre'] for s in st.session_state.servicios]
+            servicios_nombres = almacen.catalogo.nombres()
             servicio_seleccionado = st.selectbox("Servicio", servicios_nombres)
-            servicio_data = next(s for s in st.session_state.servicios if s['nombre'] == servicio_seleccionado)
+            servicio_data = almacen.catalogo.buscar(servicio_seleccionado)
             
             fecha_cita = st.date_input("Fecha de la cita", 
                                      min_value=datetime.now().date())
         
         with col4:
-            horarios = ["08:00", "09:00", "10:00", "11:00", "14:00", "15:00", "16:00", "17:00"]
+            # Solo se ofrecen horas con alguna bahía libre para toda la duración
+            duracion = servicio_data['minutos']
+            horarios = almacen.agenda().horarios_libres(fecha_cita, duracion)
             hora_cita = st.selectbox("Hora", horarios)
+            if not horarios:
+                siguientes = almacen.agenda().siguientes_libres(duracion, 3, fecha_cita)
+                st.warning("No hay horarios libres ese día. Próximos disponibles: " +
+                           ", ".join(f"{fecha:%d/%m/%Y} {hora}" for fecha, hora in siguientes))
             
             st.markdown(f"**Precio estimado:** ${servicio_data['precio']:,}")
             st.markdown(f"**Duración:** {servicio_data['duracion']}")
         
         # Botón para agendar
         if st.button("Confirmar Cita", type="primary"):
-            if cliente_nuevo:
-                # Crear nuevo cliente
-                nuevo_cliente_id = generate_id("CLI")
-                nuevo_cliente = pd.DataFrame({
-                    'id': [nuevo_cliente_id],
-                    'nombre': [nombre],
-                    'telefono': [telefono],
-                    'email': [email],
-                    'fecha_registro': [datetime.now().strftime('%Y-%m-%d')]
-                })
-                st.session_state.clientes = pd.concat([st.session_state.clientes, nuevo_cliente], 
-                                                    ignore_index=True)
-                
-                # Crear nuevo vehículo
-                nuevo_vehiculo_id = generate_id("VEH")
-                nuevo_vehiculo = pd.DataFrame({
-                    'id': [nuevo_vehiculo_id],
-                    'cliente_id': [nuevo_cliente_id],
-                    'marca': [marca],
-                    'modelo': [modelo],
-                    'año': [año],
-                    'placa': [placa]
-                })
-                st.session_state.vehiculos = pd.concat([st.session_state.vehiculos, nuevo_vehiculo], 
-                                                     ignore_index=True)
-                
-                cliente_id_cita = nuevo_cliente_id
-                vehiculo_id_cita = nuevo_vehiculo_id
+            if hora_cita is None:
+                st.error("No hay horarios disponibles para la fecha seleccionada.")
             else:
-                cliente_id_cita = cliente_data['id']
-                vehiculo_id_cita = vehiculos_cliente.iloc[0]['id']
-            
-            # Crear nueva cita
-            nueva_cita_id = generate_id("CIT")
-            nueva_cita = pd.DataFrame({
-                'id': [nueva_cita_id],
-                'cliente_id': [cliente_id_cita],
-                'vehiculo_id': [vehiculo_id_cita],
-                'servicio': [servicio_seleccionado],
-                'fecha': [fecha_cita.strftime('%Y-%m-%d')],
-                'hora': [hora_cita],
-                'estado': ['Confirmada'],
-                'precio': [servicio_data['precio']]
-            })
-            
-            st.session_state.citas = pd.concat([st.session_state.citas, nueva_cita], 
-                                             ignore_index=True)
-            
-            st.markdown(f"""
-            <div class="success-msg">
-                ✅ <strong>¡Cita agendada exitosamente!</strong><br>
-                <strong>ID de cita:</strong> {nueva_cita_id}<br>
-                <strong>Fecha:</strong> {fecha_cita.strftime('%d/%m/%Y')} a las {hora_cita}<br>
-                <strong>Servicio:</strong> {servicio_seleccionado}
-            </div>
-            """, unsafe_allow_html=True)
+                if cliente_nuevo:
+                    # Crear nuevo cliente
+                    nuevo_cliente_id = almacen.nuevo_id('clientes')
+                    almacen.insertar('clientes', {
+                        'id': nuevo_cliente_id,
+                        'nombre': nombre,
+                        'telefono': telefono,
+                        'email': email,
+                        'fecha_registro': datetime.now().strftime('%Y-%m-%d')
+                    })
+                    
+                    # Crear nuevo vehículo
+                    nuevo_vehiculo_id = almacen.nuevo_id('vehiculos')
+                    almacen.insertar('vehiculos', {
+                        'id': nuevo_vehiculo_id,
+                        'cliente_id': nuevo_cliente_id,
+                        'marca': marca,
+                        'modelo': modelo,
+                        'año': año,
+                        'placa': placa
+                    })
+                    
+                    cliente_id_cita = nuevo_cliente_id
+                    vehiculo_id_cita = nuevo_vehiculo_id
+                else:
+                    cliente_id_cita = cliente_data['id']
+                    vehiculo_id_cita = vehiculos_cliente.iloc[0]['id']
+                
+                # Crear nueva cita; la reserva del hueco y el alta son atómicas
+                nueva_cita_id = almacen.nuevo_id('citas')
+                try:
+                    almacen.agendar_cita({
+                        'id': nueva_cita_id,
+                        'cliente_id': cliente_id_cita,
+                        'vehiculo_id': vehiculo_id_cita,
+                        'servicio': servicio_seleccionado,
+                        'fecha': fecha_cita.strftime('%Y-%m-%d'),
+                        'hora': hora_cita,
+                        'estado': EstadoCita.CONFIRMADA,
+                        'precio': servicio_data['precio']
+                    })
+                except HorarioNoDisponible as error:
+                    st.error(f"❌ {error}. Elija otro horario.")
+                else:
+                    st.markdown(f"""
+                    <div class="success-msg">
+                        ✅ <strong>¡Cita agendada exitosamente!</strong><br>
+                        <strong>ID de cita:</strong> {nueva_cita_id}<br>
+                        <strong>Fecha:</strong> {fecha_cita.strftime('%d/%m/%Y')} a las {hora_cita}<br>
+                        <strong>Servicio:</strong> {servicio_seleccionado}
+                    </div>
+                    """, unsafe_allow_html=True)
     
-    with tabs[1]:
+    with tabs[1], perfil.tramo("Mis Citas"):
         st.markdown("### Lista de Citas")
         
         # Filtros
@@ -353,78 +355,127 @@ def modulo_citas():
         with col_filtro1:
             filtro_fecha = st.date_input("Filtrar por fecha", value=None)
         with col_filtro2:
-            estados = ['Todas', 'Confirmada', 'Pendiente', 'Completada', 'Cancelada']
+            estados = ['Todas'] + ESTADOS
             filtro_estado = st.selectbox("Filtrar por estado", estados)
         with col_filtro3:
             if st.button("Limpiar filtros"):
                 filtro_fecha = None
                 filtro_estado = 'Todas'
         
-        # Aplicar filtros
-        citas_filtradas = st.session_state.citas.copy()
+        # Aplicar filtros: la consulta solo materializa las filas de la página
+        citas_filtradas = almacen.consultar_citas()
         
         if filtro_fecha:
-            citas_filtradas = citas_filtradas[
-                citas_filtradas['fecha'] == filtro_fecha.strftime('%Y-%m-%d')
-            ]
+            citas_filtradas.en_fechas(filtro_fecha)
         
         if filtro_estado != 'Todas':
-            citas_filtradas = citas_filtradas[
-                citas_filtradas['estado'] == filtro_estado
-            ]
+            citas_filtradas.con_estados([filtro_estado])
+        
+        # Paginación: pila de cursores (fecha, hora, id) por sesión,
+        # reiniciada cuando cambian los filtros
+        tamaño_pagina = st.selectbox("Citas por página", [10, 25, 50], index=1)
+        firma_filtros = (filtro_fecha, filtro_estado, tamaño_pagina)
+        if st.session_state.get('citas_filtros') != firma_filtros:
+            st.session_state.citas_filtros = firma_filtros
+            st.session_state.citas_cursores = [None]
+        cursores = st.session_state.citas_cursores
+        numero_pagina = len(cursores)
+        
+        # Resultado de la última acción en lote; se muestra aunque la acción
+        # haya vaciado el filtro actual
+        if 'aviso_lote' in st.session_state:
+            st.success(st.session_state.pop('aviso_lote'))
         
         # Mostrar citas
         if len(citas_filtradas) > 0:
-            for _, cita in citas_filtradas.iterrows():
-                cliente_info = st.session_state.clientes[
-                    st.session_state.clientes['id'] == cita['cliente_id']
-                ].iloc[0]
+            pagina, hay_mas = citas_filtradas.pagina(cursores[-1], tamaño_pagina)
+            textos = texto_citas(pagina)
+            
+            # Acciones en lote: una sola transacción y un solo rerun para
+            # todas las citas elegidas (p. ej. cerrar el día)
+            with st.expander("⚡ Acciones en lote"):
+                if st.checkbox(f"Aplicar a las {len(citas_filtradas)} citas filtradas", key="lote_todas"):
+                    seleccion = citas_filtradas.ids()
+                else:
+                    etiquetas = dict(zip(pagina['id'], pagina['id'] + ' · ' + pagina['cliente_nombre'].astype(str)
+                                         + ' · ' + pagina['fecha_texto'] + ' ' + pagina['hora_texto']))
+                    seleccion = st.multiselect("Citas de esta página", list(etiquetas),
+                                               format_func=etiquetas.get, key=f"lote_{numero_pagina}")
                 
-                vehiculo_info = st.session_state.vehiculos[
-                    st.session_state.vehiculos['id'] == cita['vehiculo_id']
-                ].iloc[0]
+                accion = st.radio("Acción", ["Confirmar", "Completar", "Cancelar", "Reprogramar"],
+                                  horizontal=True, key="lote_accion")
+                if accion == "Reprogramar":
+                    col_lote1, col_lote2 = st.columns(2)
+                    with col_lote1:
+                        nueva_fecha = st.date_input("Nueva fecha", min_value=datetime.now().date(),
+                                                    key="lote_fecha")
+                    with col_lote2:
+                        nueva_hora = st.selectbox("Nueva hora", ["Mantener la hora de cada cita"] + HORARIOS_CITA,
+                                                  key="lote_hora")
                 
+                if st.button(f"Aplicar a {len(seleccion)} citas", disabled=not seleccion, key="lote_aplicar"):
+                    estados_accion = {"Confirmar": EstadoCita.CONFIRMADA, "Completar": EstadoCita.COMPLETADA,
+                                      "Cancelar": EstadoCita.CANCELADA}
+                    try:
+                        if accion == "Reprogramar":
+                            hora = None if nueva_hora not in HORARIOS_CITA else nueva_hora
+                            cambiadas = almacen.reprogramar_citas(seleccion, nueva_fecha, hora)
+                        else:
+                            # Las citas que no admiten la transición se omiten
+                            cambiadas = almacen.cambiar_estados(seleccion, estados_accion[accion],
+                                                                omitir_invalidas=True)
+                    except (TransicionInvalida, ConflictoConcurrencia, HorarioNoDisponible,
+                            StockInsuficiente) as error:
+                        st.error(str(error))
+                    else:
+                        omitidas = len(seleccion) - len(cambiadas)
+                        st.session_state.aviso_lote = (
+                            f"{accion}: {len(cambiadas)} citas actualizadas"
+                            + (f", {omitidas} omitidas por su estado" if omitidas else ""))
+                        st.rerun()
+            for cita_id, estado, texto in zip(pagina['id'], pagina['estado'], textos):
                 col_cita1, col_cita2, col_cita3 = st.columns([2, 1, 1])
                 
                 with col_cita1:
-                    st.markdown(f"""
-                    **Cliente:** {cliente_info['nombre']}  
-                    **Vehículo:** {vehiculo_info['marca']} {vehiculo_info['modelo']} ({vehiculo_info['placa']})  
-                    **Servicio:** {cita['servicio']}  
-                    **Fecha:** {cita['fecha']} - {cita['hora']}  
-                    **Estado:** {cita['estado']}  
-                    **Precio:** ${cita['precio']:,}
-                    """)
+                    st.markdown(texto)
                 
+                # Solo se ofrecen las transiciones que permite la máquina de estados
                 with col_cita2:
-                    if st.button(f"Cancelar", key=f"cancel_{cita['id']}"):
-                        st.session_state.citas.loc[
-                            st.session_state.citas['id'] == cita['id'], 'estado'
-                        ] = 'Cancelada'
-                        st.rerun()
+                    if transicion_valida(estado, EstadoCita.CANCELADA):
+                        if st.button("Cancelar", key=f"cancel_{numero_pagina}_{cita_id}"):
+                            cambiar_estado_cita(cita_id, EstadoCita.CANCELADA)
                 
                 with col_cita3:
-                    if cita['estado'] == 'Confirmada':
-                        if st.button(f"Completar", key=f"complete_{cita['id']}"):
-                            st.session_state.citas.loc[
-                                st.session_state.citas['id'] == cita['id'], 'estado'
-                            ] = 'Completada'
-                            st.rerun()
+                    if estado == EstadoCita.PENDIENTE:
+                        if st.button("Confirmar", key=f"confirm_{numero_pagina}_{cita_id}"):
+                            cambiar_estado_cita(cita_id, EstadoCita.CONFIRMADA)
+                    elif estado == EstadoCita.CONFIRMADA:
+                        if st.button("Completar", key=f"complete_{numero_pagina}_{cita_id}"):
+                            # Descuenta del inventario los materiales del servicio
+                            cambiar_estado_cita(cita_id, EstadoCita.COMPLETADA)
                 
                 st.divider()
+            
+            col_pag1, col_pag2, col_pag3 = st.columns([1, 2, 1])
+            with col_pag1:
+                if st.button("⬅️ Anterior", key="citas_anterior", disabled=numero_pagina == 1):
+                    cursores.pop()
+                    st.rerun()
+            with col_pag2:
+                st.caption(f"Página {numero_pagina} · {len(citas_filtradas)} citas")
+            with col_pag3:
+                if st.button("Siguiente ➡️", key="citas_siguiente", disabled=not hay_mas):
+                    cursores.append(pagina['clave_orden'].iloc[-1])
+                    st.rerun()
         else:
             st.info("No hay citas que coincidan con los filtros seleccionados.")
     
-    with tabs[2]:
+    with tabs[2], perfil.tramo("Buscar Cliente"):
         st.markdown("### Buscar Cliente")
-        busqueda = st.text_input("Buscar por nombre, teléfono o email")
+        busqueda = st.text_input("Buscar por nombre, teléfono, email o placa")
         
         if busqueda:
-            clientes_encontrados = st.session_state.clientes[
-                st.session_state.clientes['nombre'].str.contains(busqueda, case=False, na=False) |
-                st.session_state.clientes['telefono'].str.contains(busqueda, case=False, na=False) |
-                st.session_state.clientes['email'].str.contains(busqueda, case=False, na=False)
-            ]
+            clientes_encontrados = almacen.buscar_clientes(busqueda)
             
             if len(clientes_encontrados) > 0:
                 st.dataframe(clientes_encontrados, use_container_width=True)
@@ -438,7 +489,7 @@ def lista_servicios():
     # Mostrar servicios en cards
     col1, col2 = st.columns(2)
     
-    for i, servicio in enumerate(st.session_state.servicios):
+    for i, servicio in enumerate(almacen.catalogo):
         with col1 if i % 2 == 0 else col2:
             st.markdown(f"""
             <div class="service-card">
@@ -454,15 +505,15 @@ def registro_clientes():
     
     tabs = st.tabs(["Clientes", "Vehículos", "Nuevo Cliente"])
     
-    with tabs[0]:
+    with tabs[0], perfil.tramo("Clientes"):
         st.markdown("### Lista de Clientes")
-        st.dataframe(st.session_state.clientes, use_container_width=True)
+        st.dataframe(almacen.tabla('clientes'), use_container_width=True)
     
-    with tabs[1]:
+    with tabs[1], perfil.tramo("Vehículos"):
         st.markdown("### Lista de Vehículos")
         # Combinar datos de vehículos con información del cliente
-        vehiculos_con_cliente = st.session_state.vehiculos.merge(
-            st.session_state.clientes[['id', 'nombre']], 
+        vehiculos_con_cliente = almacen.tabla('vehiculos').merge(
+            almacen.tabla('clientes')[['id', 'nombre']], 
             left_on='cliente_id', 
             right_on='id', 
             suffixes=('', '_cliente')
@@ -473,7 +524,7 @@ def registro_clientes():
         vehiculos_con_cliente.columns = ['ID', 'Cliente', 'Marca', 'Modelo', 'Año', 'Placa']
         st.dataframe(vehiculos_con_cliente, use_container_width=True)
     
-    with tabs[2]:
+    with tabs[2], perfil.tramo("Nuevo Cliente"):
         st.markdown("### Registrar Nuevo Cliente")
         
         col1, col2 = st.columns(2)
@@ -494,29 +545,25 @@ def registro_clientes():
         if st.button("Registrar Cliente y Vehículo", type="primary"):
             if nombre and telefono and marca and modelo and placa:
                 # Crear cliente
-                nuevo_cliente_id = generate_id("CLI")
-                nuevo_cliente = pd.DataFrame({
-                    'id': [nuevo_cliente_id],
-                    'nombre': [nombre],
-                    'telefono': [telefono],
-                    'email': [email],
-                    'fecha_registro': [datetime.now().strftime('%Y-%m-%d')]
+                nuevo_cliente_id = almacen.nuevo_id('clientes')
+                almacen.insertar('clientes', {
+                    'id': nuevo_cliente_id,
+                    'nombre': nombre,
+                    'telefono': telefono,
+                    'email': email,
+                    'fecha_registro': datetime.now().strftime('%Y-%m-%d')
                 })
-                st.session_state.clientes = pd.concat([st.session_state.clientes, nuevo_cliente], 
-                                                    ignore_index=True)
                 
                 # Crear vehículo
-                nuevo_vehiculo_id = generate_id("VEH")
-                nuevo_vehiculo = pd.DataFrame({
-                    'id': [nuevo_vehiculo_id],
-                    'cliente_id': [nuevo_cliente_id],
-                    'marca': [marca],
-                    'modelo': [modelo],
-                    'año': [año],
-                    'placa': [placa]
+                nuevo_vehiculo_id = almacen.nuevo_id('vehiculos')
+                almacen.insertar('vehiculos', {
+                    'id': nuevo_vehiculo_id,
+                    'cliente_id': nuevo_cliente_id,
+                    'marca': marca,
+                    'modelo': modelo,
+                    'año': año,
+                    'placa': placa
                 })
-                st.session_state.vehiculos = pd.concat([st.session_state.vehiculos, nuevo_vehiculo], 
-                                                     ignore_index=True)
                 
                 st.success(f"✅ Cliente y vehículo registrados exitosamente. ID Cliente: {nuevo_cliente_id}")
             else:
@@ -528,30 +575,29 @@ def inventario():
     
     tabs = st.tabs(["Inventario Actual", "Agregar Item", "Stock Bajo"])
     
-    with tabs[0]:
+    with tabs[0], perfil.tramo("Inventario Actual"):
         st.markdown("### Inventario Actual")
         
         # Mostrar inventario con alertas de stock bajo
-        inventario_display = st.session_state.inventario.copy()
-        inventario_display['Estado'] = inventario_display.apply(
-            lambda row: '🔴 Stock Bajo' if row['stock'] <= row['stock_minimo'] else '✅ OK', 
-            axis=1
-        )
-        
-        st.dataframe(inventario_display, use_container_width=True)
+        st.dataframe(almacen.vista_inventario(), use_container_width=True)
+        
+        # Gráfico de stock (plotly se importa dentro de cada gráfico, así las
+        # páginas sin gráficos no pagan su importación)
+        def grafico_stock():
+            import plotly.express as px
+            return px.bar(
+                almacen.tabla('inventario'), 
+                x='item', 
+                y='stock',
+                title='Niveles de Stock por Item',
+                color='stock',
+                color_continuous_scale='RdYlGn'
+            )
         
-        # Gráfico de stock
-        fig = px.bar(
-            st.session_state.inventario, 
-            x='item', 
-            y='stock',
-            title='Niveles de Stock por Item',
-            color='stock',
-            color_continuous_scale='RdYlGn'
-        )
+        fig = almacen.derivado('stock', (), ['inventario'], grafico_stock)
         st.plotly_chart(fig, use_container_width=True)
     
-    with tabs[1]:
+    with tabs[1], perfil.tramo("Agregar Item"):
         st.markdown("### Agregar Nuevo Item")
         
         col1, col2 = st.columns(2)
@@ -567,63 +613,82 @@ def inventario():
         
         if st.button("Agregar Item", type="primary"):
             if item_nombre and proveedor:
-                nuevo_item_id = generate_id("INV")
-                nuevo_item = pd.DataFrame({
-                    'id': [nuevo_item_id],
-                    'item': [item_nombre],
-                    'stock': [stock_inicial],
-                    'stock_minimo': [stock_minimo],
-                    'precio': [precio],
-                    'proveedor': [proveedor]
+                nuevo_item_id = almacen.nuevo_id('inventario')
+                almacen.insertar('inventario', {
+                    'id': nuevo_item_id,
+                    'item': item_nombre,
+                    'stock': stock_inicial,
+                    'stock_minimo': stock_minimo,
+                    'precio': precio,
+                    'proveedor': proveedor
                 })
-                st.session_state.inventario = pd.concat([st.session_state.inventario, nuevo_item], 
-                                                      ignore_index=True)
                 st.success(f"✅ Item agregado exitosamente. ID: {nuevo_item_id}")
             else:
                 st.error("Complete todos los campos.")
         
         st.markdown("### Actualizar Stock")
         
-        if len(st.session_state.inventario) > 0:
+        nombres_inventario = almacen.nombres_inventario()
+        if nombres_inventario:
             item_seleccionado = st.selectbox(
                 "Seleccionar item", 
-                st.session_state.inventario['item'].tolist()
+                list(nombres_inventario),
+                format_func=nombres_inventario.get
             )
             
-            item_actual = st.session_state.inventario[
-                st.session_state.inventario['item'] == item_seleccionado
-            ].iloc[0]
+            item_actual = almacen.buscar('inventario', item_seleccionado)
+            # Versión y stock sobre los que el usuario edita. Mientras no
+            # toque el campo, ambos siguen al valor guardado; si lo editó y
+            # otra terminal cambia el stock, la escritura se rechaza
+            clave_stock = f"nuevo_stock_{item_seleccionado}"
+            clave_base = f"base_stock_{item_seleccionado}"
+            base = st.session_state.get(clave_base)
+            sin_editar = base is None or st.session_state.get(clave_stock, base['stock']) == base['stock']
+            if sin_editar and (base is None or base['version'] != int(item_actual['version'])):
+                base = {'version': int(item_actual['version']), 'stock': int(item_actual['stock'])}
+                st.session_state[clave_base] = base
+                st.session_state[clave_stock] = base['stock']
             
             col3, col4 = st.columns(2)
             
             with col3:
                 st.info(f"Stock actual: {item_actual['stock']}")
-                nuevo_stock = st.number_input("Nuevo stock", min_value=0, value=int(item_actual['stock']))
+                nuevo_stock = st.number_input("Nuevo stock", min_value=0, key=clave_stock)
+                if base['version'] != int(item_actual['version']):
+                    st.warning(f"El stock cambió a {item_actual['stock']} desde que empezó a editarlo.")
             
             with col4:
                 if st.button("Actualizar Stock"):
-                    st.session_state.inventario.loc[
-                        st.session_state.inventario['item'] == item_seleccionado, 'stock'
-                    ] = nuevo_stock
-                    st.success("Stock actualizado exitosamente")
-                    st.rerun()
+                    del st.session_state[clave_base]
+                    try:
+                        almacen.actualizar_versionado('inventario', item_seleccionado, base['version'], stock=nuevo_stock)
+                    except ConflictoConcurrencia:
+                        st.error("El stock cambió mientras lo editaba. Revise el valor actual e inténtelo de nuevo.")
+                    else:
+                        st.success("Stock actualizado exitosamente")
+                        st.rerun()
     
-    with tabs[2]:
+    with tabs[2], perfil.tramo("Stock Bajo"):
         st.markdown("### Items con Stock Bajo")
+        st.caption("Un item entra en alerta cuando su stock llega al punto de reorden: el stock mínimo "
+                   "más lo que se consume mientras llega un pedido, según las citas completadas recientes.")
         
-        items_bajo_stock = st.session_state.inventario[
-            st.session_state.inventario['stock'] <= st.session_state.inventario['stock_minimo']
-        ]
+        # Alertas ordenadas por días hasta agotarse, la más urgente primero
+        pronostico = almacen.pronostico()
+        items_bajo_stock = pronostico.frame(pronostico.alertas())
         
         if len(items_bajo_stock) > 0:
             st.warning(f"⚠️ {len(items_bajo_stock)} items con stock bajo:")
             
-            for _, item in items_bajo_stock.iterrows():
+            for item in items_bajo_stock.itertuples():
+                detalle = almacen.buscar('inventario', item.id)
+                agotamiento = (f"se agota en {item.dias_hasta_agotar:.0f} días"
+                               if item.dias_hasta_agotar != float('inf') else "sin consumo reciente")
                 st.markdown(f"""
                 <div class="warning-msg">
-                    <strong>{item['item']}</strong><br>
-                    Stock actual: {item['stock']} | Stock mínimo: {item['stock_minimo']}<br>
-                    Proveedor: {item['proveedor']}
+                    <strong>{item.item}</strong> ({agotamiento})<br>
+                    Stock actual: {item.stock} | Punto de reorden: {item.punto_reorden} | Stock mínimo: {detalle['stock_minimo']}<br>
+                    Proveedor: {detalle['proveedor']}
                 </div>
                 """, unsafe_allow_html=True)
         else:
@@ -637,80 +702,82 @@ def panel_admin():
     
     st.title("⚙️ Panel Administrativo")
     
+    metricas = almacen.metricas()
+    
     # Métricas principales
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_clientes = len(st.session_state.clientes)
+        total_clientes = almacen.contar('clientes')
         st.metric("👥 Total Clientes", total_clientes)
     
     with col2:
-        total_citas = len(st.session_state.citas)
+        total_citas = almacen.contar('citas')
         st.metric("📅 Total Citas", total_citas)
     
     with col3:
-        citas_hoy = len(st.session_state.citas[
-            st.session_state.citas['fecha'] == datetime.now().strftime('%Y-%m-%d')
-        ])
+        citas_hoy = metricas.citas_en(datetime.now().strftime('%Y-%m-%d'))
         st.metric("📅 Citas Hoy", citas_hoy)
     
     with col4:
-        ingresos_mes = st.session_state.citas[
-            st.session_state.citas['estado'] == 'Completada'
-        ]['precio'].sum()
+        ingresos_mes = metricas.ingresos_completadas
         st.metric("💰 Ingresos", f"${ingresos_mes:,}")
     
     st.divider()
     
     # Tabs del panel administrativo
-    tabs = st.tabs(["📊 Dashboard", "📅 Calendario", "📋 Reportes", "⚙️ Configuración"])
+    tabs = st.tabs(["📊 Dashboard", "📅 Calendario", "📋 Reportes", "📦 Datos", "⚙️ Configuración",
+                    "⏱️ Rendimiento"])
     
-    with tabs[0]:
+    with tabs[0], perfil.tramo("Dashboard"):
         st.markdown("### Dashboard Principal")
         
         # Gráfico de citas por estado
         col_graph1, col_graph2 = st.columns(2)
         
         with col_graph1:
-            citas_por_estado = st.session_state.citas['estado'].value_counts()
-            fig_estados = px.pie(
-                values=citas_por_estado.values,
-                names=citas_por_estado.index,
-                title="Distribución de Citas por Estado"
-            )
+            def grafico_estados():
+                import plotly.express as px
+                citas_por_estado = pd.Series(+metricas.citas_por_estado)
+                return px.pie(
+                    values=citas_por_estado.values,
+                    names=citas_por_estado.index,
+                    title="Distribución de Citas por Estado"
+                )
+            
+            fig_estados = almacen.derivado('citas_por_estado', (), ['citas'], grafico_estados)
             st.plotly_chart(fig_estados, use_container_width=True)
         
         with col_graph2:
             # Ingresos por servicio
-            ingresos_servicio = st.session_state.citas.groupby('servicio')['precio'].sum().sort_values(ascending=False)
-            fig_ingresos = px.bar(
-                x=ingresos_servicio.values,
-                y=ingresos_servicio.index,
-                orientation='h',
-                title="Ingresos por Tipo de Servicio",
-                labels={'x': 'Ingresos ($)', 'y': 'Servicio'}
-            )
+            def grafico_ingresos():
+                import plotly.express as px
+                ingresos_servicio = pd.Series(metricas.ingresos_por_servicio).sort_values(ascending=False)
+                return px.bar(
+                    x=ingresos_servicio.values,
+                    y=ingresos_servicio.index,
+                    orientation='h',
+                    title="Ingresos por Tipo de Servicio",
+                    labels={'x': 'Ingresos ($)', 'y': 'Servicio'}
+                )
+            
+            fig_ingresos = almacen.derivado('ingresos_por_servicio', (), ['citas'], grafico_ingresos)
             st.plotly_chart(fig_ingresos, use_container_width=True)
         
         # Tabla de próximas citas
         st.markdown("### 📅 Próximas Citas")
-        proximas_citas = st.session_state.citas[
-            (st.session_state.citas['fecha'] >= datetime.now().strftime('%Y-%m-%d')) &
-            (st.session_state.citas['estado'].isin(['Confirmada', 'Pendiente']))
-        ].sort_values('fecha').head(5)
+        proximas_citas = almacen.proximas_citas(
+            5, [EstadoCita.CONFIRMADA.value, EstadoCita.PENDIENTE.value]
+        )
         
         if len(proximas_citas) > 0:
             for _, cita in proximas_citas.iterrows():
-                cliente_info = st.session_state.clientes[
-                    st.session_state.clientes['id'] == cita['cliente_id']
-                ].iloc[0]
-                
                 col_prox1, col_prox2, col_prox3 = st.columns([2, 1, 1])
                 
                 with col_prox1:
                     st.markdown(f"""
-                    **{cliente_info['nombre']}** - {cita['servicio']}  
-                    📅 {cita['fecha']} - {cita['hora']} | 💰 ${cita['precio']:,}
+                    **{cita['cliente_nombre']}** - {cita['servicio']}  
+                    📅 {cita['fecha_texto']} - {cita['hora_texto']} | 💰 ${cita['precio']:,}
                     """)
                 
                 with col_prox2:
@@ -722,7 +789,7 @@ def panel_admin():
         else:
             st.info("No hay citas próximas.")
     
-    with tabs[1]:
+    with tabs[1], perfil.tramo("Calendario"):
         st.markdown("### 📅 Calendario de Citas")
         
         # Filtros de calendario
@@ -734,54 +801,26 @@ def panel_admin():
         with col_cal2:
             fecha_hasta = st.date_input("Hasta", value=datetime.now().date() + timedelta(days=7))
         
-        # Filtrar citas por rango de fechas
-        citas_periodo = st.session_state.citas[
-            (st.session_state.citas['fecha'] >= fecha_desde.strftime('%Y-%m-%d')) &
-            (st.session_state.citas['fecha'] <= fecha_hasta.strftime('%Y-%m-%d'))
-        ].sort_values(['fecha', 'hora'])
+        # Filtrar citas por rango de fechas (ya vienen ordenadas por fecha y hora)
+        citas_periodo = almacen.citas_entre(fecha_desde, fecha_hasta)
         
         if len(citas_periodo) > 0:
-            # Agrupar por fecha
-            for fecha in sorted(citas_periodo['fecha'].unique()):
+            # Agrupar por fecha: un bloque de markdown por día
+            bloques = html_calendario(citas_periodo)
+            for fecha, bloques_dia in bloques.groupby(citas_periodo['fecha_texto'], sort=False):
                 st.markdown(f"#### 📅 {fecha}")
-                
-                citas_dia = citas_periodo[citas_periodo['fecha'] == fecha]
-                
-                for _, cita in citas_dia.iterrows():
-                    cliente_info = st.session_state.clientes[
-                        st.session_state.clientes['id'] == cita['cliente_id']
-                    ].iloc[0]
-                    
-                    vehiculo_info = st.session_state.vehiculos[
-                        st.session_state.vehiculos['id'] == cita['vehiculo_id']
-                    ].iloc[0]
-                    
-                    # Color según estado
-                    color = {
-                        'Confirmada': 'success',
-                        'Pendiente': 'warning', 
-                        'Completada': 'info',
-                        'Cancelada': 'error'
-                    }.get(cita['estado'], 'secondary')
-                    
-                    st.markdown(f"""
-                    <div style="padding: 10px; margin: 5px 0; border-left: 4px solid {'#28a745' if color=='success' else '#ffc107' if color=='warning' else '#17a2b8' if color=='info' else '#dc3545'}; background: #f8f9fa;">
-                        <strong>{cita['hora']}</strong> - {cliente_info['nombre']}<br>
-                        <strong>Servicio:</strong> {cita['servicio']}<br>
-                        <strong>Vehículo:</strong> {vehiculo_info['marca']} {vehiculo_info['modelo']} ({vehiculo_info['placa']})<br>
-                        <strong>Estado:</strong> {cita['estado']} | <strong>Precio:</strong> ${cita['precio']:,}
-                    </div>
-                    """, unsafe_allow_html=True)
+                st.markdown("".join(bloques_dia), unsafe_allow_html=True)
         else:
             st.info("No hay citas en el período seleccionado.")
     
-    with tabs[2]:
+    with tabs[2], perfil.tramo("Reportes"):
         st.markdown("### 📋 Reportes")
         
         # Selector de tipo de reporte
         tipo_reporte = st.selectbox(
             "Tipo de reporte",
-            ["Resumen General", "Ingresos por Período", "Servicios Más Solicitados", "Clientes Frecuentes"]
+            ["Resumen General", "Ingresos por Período", "Servicios Más Solicitados", "Clientes Frecuentes",
+             "Historial de Estados"]
         )
         
         if tipo_reporte == "Resumen General":
@@ -790,36 +829,42 @@ def panel_admin():
             col_rep1, col_rep2, col_rep3 = st.columns(3)
             
             with col_rep1:
-                st.metric("Total Clientes Registrados", len(st.session_state.clientes))
-                st.metric("Total Vehículos", len(st.session_state.vehiculos))
-                st.metric("Items en Inventario", len(st.session_state.inventario))
+                st.metric("Total Clientes Registrados", almacen.contar('clientes'))
+                st.metric("Total Vehículos", almacen.contar('vehiculos'))
+                st.metric("Items en Inventario", almacen.contar('inventario'))
             
             with col_rep2:
-                st.metric("Citas Totales", len(st.session_state.citas))
-                st.metric("Citas Completadas", len(st.session_state.citas[st.session_state.citas['estado'] == 'Completada']))
-                st.metric("Citas Pendientes", len(st.session_state.citas[st.session_state.citas['estado'] == 'Pendiente']))
+                st.metric("Citas Totales", almacen.contar('citas'))
+                st.metric("Citas Completadas", metricas.citas_con_estado('Completada'))
+                st.metric("Citas Pendientes", metricas.citas_con_estado('Pendiente'))
             
             with col_rep3:
-                total_ingresos = st.session_state.citas[st.session_state.citas['estado'] == 'Completada']['precio'].sum()
-                ingreso_promedio = st.session_state.citas[st.session_state.citas['estado'] == 'Completada']['precio'].mean()
+                total_ingresos = metricas.ingresos_completadas
+                ingreso_promedio = metricas.promedio_completadas()
                 st.metric("Ingresos Totales", f"${total_ingresos:,}")
-                st.metric("Ingreso Promedio", f"${ingreso_promedio:,.0f}" if not pd.isna(ingreso_promedio) else "$0")
+                st.metric("Ingreso Promedio", f"${ingreso_promedio:,.0f}" if ingreso_promedio is not None else "$0")
         
         elif tipo_reporte == "Ingresos por Período":
             st.markdown("#### Ingresos por Período")
             
-            # Crear datos de ejemplo por mes
-            citas_completadas = st.session_state.citas[st.session_state.citas['estado'] == 'Completada'].copy()
-            if len(citas_completadas) > 0:
-                citas_completadas['fecha'] = pd.to_datetime(citas_completadas['fecha'])
-                ingresos_mes = citas_completadas.groupby(citas_completadas['fecha'].dt.to_period('M'))['precio'].sum()
+            granularidad = st.radio("Agrupar por", ["Mes", "Semana"], horizontal=True)
+            frecuencia = 'M' if granularidad == "Mes" else 'W'
+            
+            def grafico_ingresos_periodo():
+                import plotly.express as px
+                ingresos_periodo = almacen.cubo().por_periodo(frecuencia, [EstadoCita.COMPLETADA])['ingresos']
+                if len(ingresos_periodo) == 0:
+                    return None
                 
-                fig_ingresos_tiempo = px.line(
-                    x=ingresos_mes.index.astype(str),
-                    y=ingresos_mes.values,
-                    title="Evolución de Ingresos Mensuales",
-                    labels={'x': 'Mes', 'y': 'Ingresos ($)'}
+                return px.line(
+                    x=ingresos_periodo.index.astype(str),
+                    y=ingresos_periodo.values,
+                    title="Evolución de Ingresos Mensuales" if frecuencia == 'M' else "Evolución de Ingresos Semanales",
+                    labels={'x': granularidad, 'y': 'Ingresos ($)'}
                 )
+            
+            fig_ingresos_tiempo = almacen.derivado('ingresos_periodo', (frecuencia,), ['citas'], grafico_ingresos_periodo)
+            if fig_ingresos_tiempo is not None:
                 st.plotly_chart(fig_ingresos_tiempo, use_container_width=True)
             else:
                 st.info("No hay citas completadas para mostrar ingresos.")
@@ -827,15 +872,20 @@ def panel_admin():
         elif tipo_reporte == "Servicios Más Solicitados":
             st.markdown("#### Servicios Más Solicitados")
             
-            servicios_count = st.session_state.citas['servicio'].value_counts()
+            servicios_count = almacen.cubo().por_servicio()['cantidad']
             
-            fig_servicios = px.bar(
-                x=servicios_count.index,
-                y=servicios_count.values,
-                title="Servicios Más Solicitados",
-                labels={'x': 'Servicio', 'y': 'Cantidad de Citas'}
-            )
-            fig_servicios.update_xaxis(tickangle=45)
+            def grafico_servicios():
+                import plotly.express as px
+                fig_servicios = px.bar(
+                    x=servicios_count.index,
+                    y=servicios_count.values,
+                    title="Servicios Más Solicitados",
+                    labels={'x': 'Servicio', 'y': 'Cantidad de Citas'}
+                )
+                fig_servicios.update_xaxes(tickangle=45)
+                return fig_servicios
+            
+            fig_servicios = almacen.derivado('servicios_solicitados', (), ['citas'], grafico_servicios)
             st.plotly_chart(fig_servicios, use_container_width=True)
             
             # Tabla detallada
@@ -844,26 +894,95 @@ def panel_admin():
         elif tipo_reporte == "Clientes Frecuentes":
             st.markdown("#### Clientes Más Frecuentes")
             
-            clientes_freq = st.session_state.citas['cliente_id'].value_counts().head(10)
-            
-            # Obtener nombres de clientes
-            clientes_nombres = []
-            for cliente_id in clientes_freq.index:
-                nombre = st.session_state.clientes[
-                    st.session_state.clientes['id'] == cliente_id
-                ]['nombre'].iloc[0]
-                clientes_nombres.append(nombre)
-            
-            fig_clientes = px.bar(
-                x=clientes_nombres,
-                y=clientes_freq.values,
-                title="Top 10 Clientes Más Frecuentes",
-                labels={'x': 'Cliente', 'y': 'Número de Citas'}
-            )
-            fig_clientes.update_xaxis(tickangle=45)
+            def grafico_clientes():
+                import plotly.express as px
+                clientes_freq = almacen.clientes_frecuentes(10)
+                
+                fig_clientes = px.bar(
+                    x=clientes_freq['nombre'],
+                    y=clientes_freq['cantidad'],
+                    title="Top 10 Clientes Más Frecuentes",
+                    labels={'x': 'Cliente', 'y': 'Número de Citas'}
+                )
+                fig_clientes.update_xaxes(tickangle=45)
+                return fig_clientes
+            
+            fig_clientes = almacen.derivado('clientes_frecuentes', (), ['citas', 'clientes'], grafico_clientes)
             st.plotly_chart(fig_clientes, use_container_width=True)
+        
+        elif tipo_reporte == "Historial de Estados":
+            st.markdown("#### Historial de Estados de las Citas")
+            
+            # Registro de eventos: solo se consulta, nunca se modifica
+            cita_historial = st.text_input("ID de cita (vacío para ver los últimos cambios)")
+            if cita_historial:
+                historial = almacen.eventos(cita_id=cita_historial.strip())
+            else:
+                historial = almacen.ultimos_eventos(100)
+            
+            if len(historial) > 0:
+                historial = historial.rename(columns={
+                    'seq': 'N°', 'cita_id': 'Cita', 'desde': 'Desde', 'hacia': 'Hacia', 'momento': 'Fecha y hora'
+                })
+                st.dataframe(historial, use_container_width=True, hide_index=True)
+            else:
+                st.info("No hay cambios de estado registrados.")
     
-    with tabs[3]:
+    with tabs[3], perfil.tramo("Datos"):
+        st.markdown("### 📦 Importar y Exportar Datos")
+        
+        col_importar, col_exportar = st.columns(2)
+        
+        with col_importar:
+            st.markdown("#### Importar")
+            tabla_importar = st.selectbox("Tabla destino", list(ESQUEMAS), key="tabla_importar")
+            archivo = st.file_uploader("Archivo CSV o Parquet", type=list(FORMATOS_DATOS))
+            st.caption("Los vehículos pueden traer el email del cliente en lugar de cliente_id, "
+                       "y las citas la placa en lugar de vehiculo_id y cliente_id.")
+            
+            if archivo is not None and st.button("Importar", type="primary"):
+                formato = archivo.name.rsplit('.', 1)[-1].lower()
+                barra = st.progress(0.0, text="Importando...")
+                
+                def progreso(resumen):
+                    avance = min(archivo.tell() / max(archivo.size, 1), 1.0)
+                    barra.progress(avance, text=f"{resumen['leidas']:,} filas leídas")
+                
+                try:
+                    resumen = almacen.importar(tabla_importar, archivo, formato, progreso=progreso)
+                except (ValueError, ImportError) as error:
+                    barra.empty()
+                    st.error(f"No se pudo importar el archivo: {error}")
+                else:
+                    barra.progress(1.0, text="Importación completa")
+                    st.success(f"{resumen['importadas']:,} de {resumen['leidas']:,} filas importadas")
+                    if resumen['importadas'] < resumen['leidas']:
+                        st.warning(
+                            f"Descartadas: {resumen['invalidas']:,} incompletas, "
+                            f"{resumen['duplicadas']:,} duplicadas y "
+                            f"{resumen['sin_referencia']:,} sin cliente o vehículo existente"
+                        )
+        
+        with col_exportar:
+            st.markdown("#### Exportar")
+            tabla_exportar = st.selectbox("Tabla", list(ESQUEMAS), key="tabla_exportar")
+            formato_exportar = st.radio("Formato", FORMATOS_DATOS, horizontal=True)
+            
+            if st.button("Preparar archivo"):
+                destino = io.BytesIO()
+                try:
+                    filas = almacen.exportar(tabla_exportar, destino, formato_exportar)
+                except ImportError as error:
+                    st.error(str(error))
+                else:
+                    st.download_button(
+                        f"⬇️ Descargar {filas:,} filas",
+                        destino.getvalue(),
+                        file_name=f"{tabla_exportar}.{formato_exportar}",
+                        mime="text/csv" if formato_exportar == "csv" else "application/octet-stream"
+                    )
+    
+    with tabs[4], perfil.tramo("Configuración"):
         st.markdown("### ⚙️ Configuración del Sistema")
         
         col_config1, col_config2 = st.columns(2)
@@ -879,18 +998,41 @@ def panel_admin():
                 
                 if st.button("Agregar Servicio"):
                     if nombre_servicio and precio_servicio > 0 and duracion_servicio:
-                        nuevo_servicio = {
-                            'nombre': nombre_servicio,
-                            'precio': precio_servicio,
-                            'duracion': duracion_servicio
-                        }
-                        st.session_state.servicios.append(nuevo_servicio)
+                        almacen.agregar_servicio(nombre_servicio, precio_servicio, duracion_servicio)
                         st.success("Servicio agregado exitosamente")
                         st.rerun()
             
+            # Materiales que descuenta del inventario cada servicio al completarse
+            with st.expander("Materiales por Servicio"):
+                servicio_materiales = st.selectbox("Servicio", almacen.catalogo.nombres(), key="servicio_materiales")
+                materiales_actuales = almacen.catalogo.materiales.get(servicio_materiales, {})
+                inventario_items = almacen.tabla('inventario')
+                nombres_items = dict(zip(inventario_items['id'], inventario_items['item']))
+                
+                items_usados = st.multiselect(
+                    "Items que consume",
+                    list(nombres_items),
+                    default=[item_id for item_id in materiales_actuales if item_id in nombres_items],
+                    format_func=nombres_items.get,
+                    key=f"items_{servicio_materiales}"
+                )
+                cantidades = {
+                    item_id: st.number_input(
+                        f"Unidades de {nombres_items[item_id]}",
+                        min_value=1,
+                        value=materiales_actuales.get(item_id, 1),
+                        key=f"cantidad_{servicio_materiales}_{item_id}"
+                    )
+                    for item_id in items_usados
+                }
+                
+                if st.button("Guardar Materiales"):
+                    almacen.definir_materiales(servicio_materiales, cantidades)
+                    st.success("Materiales actualizados")
+            
             # Lista de servicios actuales
             st.markdown("**Servicios Actuales:**")
-            for i, servicio in enumerate(st.session_state.servicios):
+            for servicio in almacen.catalogo:
                 st.markdown(f"• {servicio['nombre']} - ${servicio['precio']:,} ({servicio['duracion']})")
         
         with col_config2:
@@ -914,11 +1056,51 @@ def panel_admin():
         if st.button("🚪 Cerrar Sesión", type="secondary"):
             st.session_state.authenticated = False
             st.rerun()
+    
+    with tabs[5]:
+        st.markdown("### ⏱️ Rendimiento por Tramo")
+        st.caption("Tiempos de cada página, pestaña, vista y gráfico en este proceso. "
+                   "Con la medición apagada el costo es despreciable.")
+        
+        # La medición es del proceso, no de la sesión: el interruptor muestra
+        # el estado actual y solo lo cambia cuando este usuario lo mueve
+        def cambiar_medicion():
+            perfil.activo = st.session_state.medir_tiempos
+        
+        st.session_state.medir_tiempos = perfil.activo
+        st.toggle("Medir tiempos (todas las sesiones)", key="medir_tiempos", on_change=cambiar_medicion,
+                  help="Ajuste global: afecta a todos los usuarios conectados a este servidor")
+        resumen_tramos = perfil.resumen()
+        
+        if resumen_tramos.empty:
+            st.info("Todavía no hay mediciones. Active la medición y navegue por la aplicación.")
+        else:
+            # Percentiles por página (tramos de primer nivel)
+            paginas = resumen_tramos[resumen_tramos['tramo'] == resumen_tramos['pagina']]
+            st.markdown("#### Por Página")
+            st.dataframe(paginas.drop(columns=['pagina']).round(2), use_container_width=True, hide_index=True)
+            
+            st.markdown("#### Tramos Más Lentos")
+            st.dataframe(resumen_tramos.head(25).round(2), use_container_width=True, hide_index=True)
+            
+            col_descarga1, col_descarga2 = st.columns(2)
+            with col_descarga1:
+                st.download_button("⬇️ Métricas (Prometheus)", perfil.texto_prometheus(),
+                                   file_name="taller_metricas.prom", mime="text/plain")
+            with col_descarga2:
+                st.download_button("⬇️ Tramos (CSV)", resumen_tramos.to_csv(index=False),
+                                   file_name="taller_tramos.csv", mime="text/csv")
+        
+        if perfil.ruta:
+            st.caption(f"Archivo de métricas: {perfil.ruta}")
+        if st.button("Reiniciar mediciones"):
+            perfil.reiniciar()
+            st.rerun()
 
 # Navegación principal
 def main():
     # Sidebar de navegación
-    with st.sidebar:
+    with st.sidebar, perfil.tramo("sidebar"):
         st.title("🔧 AutoTaller Pro")
         
         if 'page' not in st.session_state:
@@ -943,13 +1125,11 @@ def main():
         
         # Información rápida
         st.markdown("### 📊 Estado Rápido")
-        st.metric("Citas Hoy", len(st.session_state.citas[
-            st.session_state.citas['fecha'] == datetime.now().strftime('%Y-%m-%d')
-        ]))
+        # Sin cargar tablas: conteo por fecha en SQLite y pronóstico sobre
+        # las completadas agregadas mientras las citas no estén en memoria
+        st.metric("Citas Hoy", almacen.citas_en(datetime.now().strftime('%Y-%m-%d')))
         
-        items_bajo_stock = len(st.session_state.inventario[
-            st.session_state.inventario['stock'] <= st.session_state.inventario['stock_minimo']
-        ])
+        items_bajo_stock = almacen.pronostico().total_alertas()
         st.metric("Items Stock Bajo", items_bajo_stock)
         
         st.divider()
@@ -957,19 +1137,21 @@ def main():
         st.markdown("Tel: (01) 234-5678")
         st.markdown("📧 contacto@autotaller.com")
     
-    # Contenido principal según la página seleccionada
-    if st.session_state.page == "inicio":
-        pantalla_inicio()
-    elif st.session_state.page == "citas":
-        modulo_citas()
-    elif st.session_state.page == "servicios":
-        lista_servicios()
-    elif st.session_state.page == "clientes":
-        registro_clientes()
-    elif st.session_state.page == "inventario":
-        inventario()
-    elif st.session_state.page == "admin":
-        panel_admin()
+    # Contenido principal según la página seleccionada, medido como un tramo por página
+    with perfil.tramo(st.session_state.page):
+        if st.session_state.page == "inicio":
+            pantalla_inicio()
+        elif st.session_state.page == "citas":
+            modulo_citas()
+        elif st.session_state.page == "servicios":
+            lista_servicios()
+        elif st.session_state.page == "clientes":
+            registro_clientes()
+        elif st.session_state.page == "inventario":
+            inventario()
+        elif st.session_state.page == "admin":
+            panel_admin()
+    perfil.volcar()
 
 # Ejecutar la aplicación
 if __name__ == "__main__":
@@ -0,0 +1,2681 @@
+# Capa de datos compartida de AutoTaller Pro
+#
+# Todas las sesiones de Streamlit leen y escriben a través de un único
+# AlmacenTaller por proceso, respaldado por SQLite en modo WAL. Las lecturas
+# se sirven desde una TablaEnMemoria por entidad, compartida entre sesiones:
+# las altas se anexan a un registro de filas y se compactan en el DataFrame
+# solo cuando alguien lo lee. En modo compartido varios procesos usan la
+# misma base y se avisan de sus escrituras con la tabla 'cambios'.
+
+import bisect
+import gc
+import heapq
+import itertools
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime, timedelta
+from enum import Enum
+
+import numpy as np
+import pandas as pd
+
+# Esquema de cada entidad: columnas en orden y tipo SQLite
+ESQUEMAS = {
+    'clientes': [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('nombre', 'TEXT NOT NULL'),
+        ('telefono', 'TEXT'),
+        ('email', 'TEXT'),
+        ('fecha_registro', 'TEXT'),
+    ],
+    'vehiculos': [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('cliente_id', 'TEXT NOT NULL REFERENCES clientes(id)'),
+        ('marca', 'TEXT'),
+        ('modelo', 'TEXT'),
+        ('año', 'INTEGER'),
+        ('placa', 'TEXT'),
+    ],
+    'citas': [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('cliente_id', 'TEXT NOT NULL REFERENCES clientes(id)'),
+        ('vehiculo_id', 'TEXT NOT NULL REFERENCES vehiculos(id)'),
+        ('servicio', 'TEXT'),
+        ('fecha', 'TEXT'),
+        ('hora', 'TEXT'),
+        ('estado', 'TEXT'),
+        ('precio', 'INTEGER'),
+    ],
+    'inventario': [
+        ('id', 'TEXT PRIMARY KEY'),
+        ('item', 'TEXT NOT NULL'),
+        ('stock', 'INTEGER'),
+        ('stock_minimo', 'INTEGER'),
+        ('precio', 'REAL'),
+        ('proveedor', 'TEXT'),
+        # Se incrementa en cada escritura (concurrencia optimista)
+        ('version', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+}
+
+# Índices hash por tabla: claves únicas (valor -> posición) y claves
+# foráneas o naturales (valor -> lista de posiciones). Las claves naturales
+# de CLAVES_DEDUPLICADO (email, placa) se indexan ya normalizadas.
+INDICES_UNICOS = {
+    'clientes': ['id'],
+    'vehiculos': ['id'],
+    'citas': ['id'],
+    'inventario': ['id'],
+}
+INDICES_MULTIPLES = {
+    'clientes': ['email'],
+    'vehiculos': ['cliente_id', 'placa'],
+    'citas': ['cliente_id', 'vehiculo_id'],
+    'inventario': [],
+}
+
+# Capacidad del taller para la agenda: bahías simultáneas, franjas de
+# 15 minutos y horario de atención por día de la semana (lunes = 0)
+BAHIAS = int(os.environ.get('TALLER_BAHIAS', 3))
+MINUTOS_FRANJA = 15
+HORARIO_ATENCION = {
+    0: ('08:00', '18:00'),
+    1: ('08:00', '18:00'),
+    2: ('08:00', '18:00'),
+    3: ('08:00', '18:00'),
+    4: ('08:00', '18:00'),
+    5: ('08:00', '14:00'),
+}
+SERVICIOS_INICIALES = [
+    {'nombre': 'Cambio de aceite', 'precio': 50000, 'duracion': '30 min'},
+    {'nombre': 'Revisión general', 'precio': 120000, 'duracion': '2 horas'},
+    {'nombre': 'Alineación y balanceo', 'precio': 80000, 'duracion': '1 hora'},
+    {'nombre': 'Cambio de frenos', 'precio': 150000, 'duracion': '1.5 horas'},
+    {'nombre': 'Diagnóstico computarizado', 'precio': 70000, 'duracion': '45 min'},
+    {'nombre': 'Cambio de filtros', 'precio': 60000, 'duracion': '45 min'}
+]
+# Materiales que consume cada servicio (id de inventario -> unidades),
+# para los items de los datos iniciales
+MATERIALES_INICIALES = {
+    'Cambio de aceite': {'INV001': 1},
+    'Cambio de filtros': {'INV002': 1},
+    'Cambio de frenos': {'INV003': 1},
+    'Revisión general': {'INV004': 4},
+}
+HORARIOS_CITA = ["08:00", "09:00", "10:00", "11:00", "14:00", "15:00", "16:00", "17:00"]
+DURACION_POR_DEFECTO = 60
+
+# Ids generados: prefijo por tabla y número de secuencia con ancho fijo,
+# de modo que el orden alfabético coincide con el orden de alta
+PREFIJOS_ID = {
+    'clientes': 'CLI',
+    'vehiculos': 'VEH',
+    'citas': 'CIT',
+    'inventario': 'INV',
+}
+DIGITOS_ID = 8
+
+RUTA_POR_DEFECTO = os.environ.get(
+    'TALLER_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taller.db')
+)
+
+# Modo multiproceso (TALLER_COMPARTIDO=1): varios procesos de Streamlit
+# comparten la base y cada uno ve los cambios de los demás con un retraso
+# de a lo sumo TALLER_SINCRONIZACION segundos
+MODO_COMPARTIDO = os.environ.get('TALLER_COMPARTIDO', '') == '1'
+INTERVALO_SINCRONIZACION = float(os.environ.get('TALLER_SINCRONIZACION', 1.0))
+RETENCION_CAMBIOS = 3600
+
+# Medición de tiempos (TALLER_PERFILADO=1, o desde el panel de admin) y
+# archivo de métricas en formato Prometheus que se reescribe periódicamente
+PERFILADO = os.environ.get('TALLER_PERFILADO', '') == '1'
+RUTA_METRICAS = os.environ.get('TALLER_METRICAS')
+
+
+def columnas(tabla):
+    return [nombre for nombre, _ in ESQUEMAS[tabla]]
+
+
+# Estados posibles de una cita
+class EstadoCita(str, Enum):
+    PENDIENTE = 'Pendiente'
+    CONFIRMADA = 'Confirmada'
+    COMPLETADA = 'Completada'
+    CANCELADA = 'Cancelada'
+
+
+ESTADOS = [estado.value for estado in EstadoCita]
+
+# Máquina de estados: a qué estados puede pasar una cita desde cada uno.
+# Completada y Cancelada son finales.
+TRANSICIONES = {
+    EstadoCita.PENDIENTE: {EstadoCita.CONFIRMADA, EstadoCita.CANCELADA},
+    EstadoCita.CONFIRMADA: {EstadoCita.COMPLETADA, EstadoCita.CANCELADA},
+    EstadoCita.COMPLETADA: set(),
+    EstadoCita.CANCELADA: set(),
+}
+
+
+ESTADOS_FINALES = {estado.value for estado, destinos in TRANSICIONES.items() if not destinos}
+
+
+# Los estados pueden llegar como texto: EstadoCita hereda de str, así que
+# 'Pendiente' y EstadoCita.PENDIENTE son la misma clave en TRANSICIONES
+def transicion_valida(desde, hacia):
+    return hacia in TRANSICIONES.get(desde, ())
+
+
+# Reproyección del estado de las citas desde su registro de eventos: cada
+# cita queda en el estado al que llevó su último evento
+SQL_REPRODUCIR_ESTADOS = '''
+    UPDATE citas SET estado = ultimo.hacia
+    FROM (SELECT cita_id, hacia FROM eventos_cita
+          WHERE seq IN (SELECT MAX(seq) FROM eventos_cita GROUP BY cita_id)) AS ultimo
+    WHERE citas.id = ultimo.cita_id AND citas.estado IS NOT ultimo.hacia
+'''
+
+# Evento de alta para las citas que no tienen ninguno (datos de ejemplo y
+# bases anteriores al registro), así toda cita parte de un evento
+SQL_EVENTOS_ALTA = '''
+    INSERT INTO eventos_cita (cita_id, desde, hacia, momento)
+    SELECT id, NULL, estado, ? FROM citas
+    WHERE estado IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM eventos_cita WHERE eventos_cita.cita_id = citas.id)
+'''
+
+# Tipos en memoria por columna. En SQLite las fechas y horas siguen como
+# texto ISO ('2024-05-01', '10:00'); al cargar se convierten a estos tipos.
+# 'fecha' es datetime64 a medianoche y 'hora' un timedelta desde las 00:00.
+TIPOS = {
+    'clientes': {
+        'fecha_registro': 'fecha',
+    },
+    'vehiculos': {
+        'marca': 'category',
+        'año': 'int16',
+    },
+    'citas': {
+        'servicio': 'category',
+        'fecha': 'fecha',
+        'hora': 'hora',
+        'estado': pd.CategoricalDtype(ESTADOS),
+        'precio': 'int32',
+    },
+    'inventario': {
+        'stock': 'int32',
+        'stock_minimo': 'int32',
+        'precio': 'float64',
+        'proveedor': 'category',
+        'version': 'int32',
+    },
+}
+
+
+# Columnas numéricas que no admiten valores negativos al importar
+NO_NEGATIVAS = {
+    'citas': ['precio'],
+    'inventario': ['stock', 'stock_minimo', 'precio'],
+}
+
+
+def a_fecha(valor):
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)):
+        return pd.NaT
+    return pd.Timestamp(valor).normalize()
+
+
+def a_hora(valor):
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)):
+        return pd.NaT
+    if isinstance(valor, str):
+        horas, minutos = valor.split(':')[:2]
+        return pd.Timedelta(hours=int(horas), minutes=int(minutos))
+    return pd.Timedelta(valor)
+
+
+# Minutos de una duración escrita a mano: '30 min', '1.5 horas', '1 hora'
+def duracion_minutos(texto):
+    coincidencia = re.match(r'\s*(\d+(?:[.,]\d+)?)\s*(h|hora|horas|m|min|mins|minutos)?\b',
+                            str(texto).lower())
+    if not coincidencia:
+        return DURACION_POR_DEFECTO
+    cantidad = float(coincidencia.group(1).replace(',', '.'))
+    unidad = coincidencia.group(2) or 'min'
+    return int(round(cantidad * 60)) if unidad.startswith('h') else int(round(cantidad))
+
+
+def texto_hora(valor):
+    minutos = int(valor.total_seconds() // 60)
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+# Texto 'HH:MM' de cada minuto del día, para traducir columnas enteras
+_TEXTOS_MINUTO = np.array([f"{m // 60:02d}:{m % 60:02d}" for m in range(24 * 60)], dtype=object)
+
+
+# Versión por columnas de texto_hora para una Serie de timedelta: una sola
+# consulta a la tabla de textos en lugar de formatear fila a fila
+def textos_hora(serie):
+    minutos = (serie.dt.total_seconds() // 60).fillna(0).astype('int64').to_numpy()
+    return pd.Series(_TEXTOS_MINUTO[minutos % (24 * 60)], index=serie.index)
+
+
+# Migración: convierte un DataFrame con columnas de texto (SQLite, CSV o
+# datos antiguos) a los tipos de TIPOS. Los enteros ausentes quedan en 0.
+# Si se pasa `invalidas` (array booleano, una posición por fila) se marcan
+# las filas con algún valor presente que no se pudo convertir.
+def aplicar_esquema(tabla, frame, invalidas=None):
+    frame = frame.copy()
+    for columna, tipo in TIPOS[tabla].items():
+        if columna not in frame:
+            continue
+        original = frame[columna]
+        numerico = isinstance(tipo, str) and tipo.startswith(('int', 'float'))
+        if tipo == 'fecha':
+            convertida = pd.to_datetime(original, errors='coerce').dt.normalize()
+        elif tipo == 'hora':
+            # Hay pocas horas distintas: cada una se interpreta una sola vez
+            # y la columna se arma por posiciones (el código -1 es NaT). Solo
+            # valen horas del día, de 00:00 a 23:59
+            codigos, unicas = pd.factorize(original)
+            partes = pd.Series(unicas, dtype='string').str.extract(r'^\s*(\d{1,2}):(\d{2})(?::\d{2})?\s*$')
+            horas, minutos = (pd.to_numeric(partes[k]).astype('float64') for k in (0, 1))
+            del_dia = (horas * 60 + minutos).where((horas < 24) & (minutos < 60))
+            horas = pd.to_timedelta(del_dia, unit='m').to_numpy().astype('timedelta64[ns]')
+            convertida = pd.Series(np.append(horas, np.timedelta64('NaT', 'ns'))[codigos], index=original.index)
+        elif numerico:
+            convertida = pd.to_numeric(original, errors='coerce')
+            if invalidas is not None:
+                # Al importar, un número que no cabe en el tipo (o con
+                # decimales en un entero, o negativo donde no tiene sentido)
+                # queda como no convertible en lugar de truncarse
+                fuera = pd.Series(columna in NO_NEGATIVAS.get(tabla, ()), index=convertida.index) & (convertida < 0)
+                if tipo.startswith('int'):
+                    limites = np.iinfo(tipo)
+                    fuera |= (convertida % 1 != 0) | (convertida < limites.min) | (convertida > limites.max)
+                convertida = convertida.where(~fuera)
+        else:
+            convertida = original.astype(tipo)
+        if invalidas is not None:
+            invalidas |= (original.notna() & convertida.isna()).to_numpy()
+        frame[columna] = convertida.fillna(0).astype(tipo) if numerico else convertida
+    return frame
+
+
+# Lleva los valores de un registro suelto a los tipos en memoria
+def normalizar_registro(tabla, registro):
+    normalizado = {}
+    for columna in columnas(tabla):
+        valor = registro.get(columna)
+        if isinstance(valor, Enum):
+            valor = valor.value
+        tipo = TIPOS[tabla].get(columna)
+        if tipo == 'fecha':
+            valor = a_fecha(valor)
+        elif tipo == 'hora':
+            valor = a_hora(valor)
+        elif isinstance(tipo, str) and tipo.startswith('int'):
+            valor = int(valor or 0)
+        elif isinstance(tipo, str) and tipo.startswith('float'):
+            valor = float(valor or 0)
+        normalizado[columna] = valor
+    return normalizado
+
+
+# Concatena dos partes de una tabla tipada sin perder las categorías
+def concatenar_tipado(frame, nuevas):
+    for columna in frame.columns:
+        tipo = frame[columna].dtype
+        if isinstance(tipo, pd.CategoricalDtype):
+            faltan = pd.Index(nuevas[columna].dropna().unique()).difference(tipo.categories)
+            if len(faltan):
+                tipo = pd.CategoricalDtype(tipo.categories.append(faltan), ordered=tipo.ordered)
+                frame = frame.assign(**{columna: frame[columna].astype(tipo)})
+            nuevas[columna] = nuevas[columna].astype(tipo)
+        elif tipo != nuevas[columna].dtype and len(nuevas[columna].dropna()):
+            nuevas[columna] = nuevas[columna].astype(tipo)
+    return pd.concat([frame, nuevas], ignore_index=True)
+
+
+# Convierte valores en memoria a tipos que sqlite3 sabe enlazar
+def _a_sql(valor):
+    if valor is None or valor is pd.NaT:
+        return None
+    if isinstance(valor, Enum):
+        return valor.value
+    if isinstance(valor, pd.Timestamp):
+        return valor.strftime('%Y-%m-%d')
+    if isinstance(valor, (pd.Timedelta, timedelta)):
+        return texto_hora(valor)
+    if isinstance(valor, date):
+        return valor.isoformat()
+    if hasattr(valor, 'item'):
+        return valor.item()
+    if isinstance(valor, float) and pd.isna(valor):
+        return None
+    return valor
+
+
+# Datos iniciales para una base recién creada
+def _datos_semilla():
+    hoy = datetime.now()
+    return {
+        'clientes': [
+            ('CLI001', 'Juan Pérez', '123456789', 'juan@email.com', hoy.strftime('%Y-%m-%d')),
+            ('CLI002', 'María García', '987654321', 'maria@email.com', hoy.strftime('%Y-%m-%d')),
+        ],
+        'vehiculos': [
+            ('VEH001', 'CLI001', 'Toyota', 'Corolla', 2020, 'ABC123'),
+            ('VEH002', 'CLI002', 'Honda', 'Civic', 2019, 'XYZ789'),
+        ],
+        'citas': [
+            ('CIT001', 'CLI001', 'VEH001', 'Cambio de aceite',
+             (hoy + timedelta(days=1)).strftime('%Y-%m-%d'), '10:00', 'Confirmada', 50000),
+            ('CIT002', 'CLI002', 'VEH002', 'Revisión general',
+             (hoy + timedelta(days=2)).strftime('%Y-%m-%d'), '14:00', 'Pendiente', 120000),
+        ],
+        'inventario': [
+            ('INV001', 'Aceite motor 5W-30', 25, 10, 25000, 'Lubricantes S.A.', 0),
+            ('INV002', 'Filtro aire', 15, 10, 35000, 'Filtros Pro', 0),
+            ('INV003', 'Pastillas freno', 8, 5, 80000, 'Frenos Total', 0),
+            ('INV004', 'Bujías', 30, 20, 15000, 'Bujías Max', 0),
+        ],
+    }
+
+
+# Consulta sobre la vista de citas (ordenada por 'clave_orden') que combina
+# filtros sin recorrer ni copiar la tabla: la fecha acota un tramo con dos
+# búsquedas binarias y el estado usa las posiciones precalculadas de cada
+# estado. Solo se materializan las filas de la página que se pide.
+class ConsultaCitas:
+    def __init__(self, vista, por_estado):
+        self._vista = vista
+        self._por_estado = por_estado
+        self._desde, self._hasta = 0, len(vista)
+        self._estados = None
+        self._posiciones = None
+
+    def en_fechas(self, desde, hasta=None):
+        fechas = self._vista['fecha']
+        self._desde = max(self._desde, int(fechas.searchsorted(a_fecha(desde), side='left')))
+        self._hasta = min(self._hasta, int(fechas.searchsorted(a_fecha(hasta or desde), side='right')))
+        self._posiciones = None
+        return self
+
+    def con_estados(self, estados):
+        estados = {getattr(e, 'value', e) for e in estados}
+        self._estados = estados if self._estados is None else self._estados & estados
+        self._posiciones = None
+        return self
+
+    # Posiciones de la vista que cumplen todos los filtros, en orden; sin
+    # filtro de estado es el tramo de fechas tal cual
+    def posiciones(self):
+        if self._posiciones is None:
+            if self._estados is None:
+                self._posiciones = range(self._desde, max(self._hasta, self._desde))
+            else:
+                listas = [self._por_estado.get(estado, np.empty(0, np.int64)) for estado in self._estados]
+                todas = np.sort(np.concatenate(listas)) if listas else np.empty(0, np.int64)
+                inicio, fin = np.searchsorted(todas, [self._desde, self._hasta])
+                self._posiciones = todas[inicio:fin]
+        return self._posiciones
+
+    def __len__(self):
+        return len(self.posiciones())
+
+    # Ids de todas las citas que cumplen los filtros (acciones en lote)
+    def ids(self):
+        return self._vista['id'].to_numpy()[np.asarray(self.posiciones(), dtype=np.int64)].tolist()
+
+    # Página de filas posteriores al cursor (la 'clave_orden' de la última
+    # fila vista) y si quedan más
+    def pagina(self, despues=None, tamaño=25):
+        posiciones = self.posiciones()
+        inicio = 0
+        if despues is not None:
+            corte = int(self._vista['clave_orden'].searchsorted(despues, side='right'))
+            if isinstance(posiciones, range):
+                inicio = max(0, corte - posiciones.start)
+            else:
+                inicio = int(np.searchsorted(posiciones, corte))
+        seleccion = posiciones[inicio:inicio + tamaño]
+        if isinstance(seleccion, range):
+            pagina = self._vista.iloc[seleccion.start:seleccion.stop]
+        else:
+            pagina = self._vista.iloc[seleccion]
+        return pagina, inicio + tamaño < len(posiciones)
+
+
+# Las altas masivas crean cientos de miles de tuplas y cada tanto disparan
+# el recolector de ciclos, que recorre todo lo que ya vive en memoria
+# (tablas, índices). Mientras dura el bloque queda en pausa; con varios
+# bloques a la vez se reanuda al salir el último, si estaba activo.
+_pausas_recolector = {'cuantas': 0, 'activo': True}
+_lock_recolector = threading.Lock()
+
+
+@contextmanager
+def recolector_pausado():
+    with _lock_recolector:
+        if _pausas_recolector['cuantas'] == 0:
+            _pausas_recolector['activo'] = gc.isenabled()
+            gc.disable()
+        _pausas_recolector['cuantas'] += 1
+    try:
+        yield
+    finally:
+        with _lock_recolector:
+            _pausas_recolector['cuantas'] -= 1
+            if _pausas_recolector['cuantas'] == 0 and _pausas_recolector['activo']:
+                gc.enable()
+
+
+# Máscara de pertenencia de una Serie a un set o dict de Python; con
+# cadenas respaldadas por Arrow es mucho más rápida que Series.isin
+def en_claves(serie, claves):
+    return np.fromiter(map(claves.__contains__, serie.tolist()), bool, len(serie))
+
+
+def formato_id(tabla, numero):
+    return f'{PREFIJOS_ID[tabla]}{numero:0{DIGITOS_ID}d}'
+
+
+# Mayor número de secuencia entre los ids con el formato del generador
+def numero_maximo(tabla, ids):
+    prefijo = PREFIJOS_ID[tabla]
+    propios = ids[ids.str.fullmatch(prefijo + r'\d{%d}' % DIGITOS_ID, na=False)]
+    return int(propios.str.slice(len(prefijo)).astype('int64').max()) if len(propios) else 0
+
+
+# Ids ordenables y sin colisiones: una secuencia por tabla en SQLite. Cada
+# proceso reserva bloques de números de una vez, así que un alta suelta no
+# escribe en la tabla de secuencias; una importación reserva todo un bloque.
+class GeneradorIds:
+    TAMAÑO_RESERVA = 32
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._reservas = {}
+
+    # Avanza la secuencia en una sola sentencia, atómica entre procesos
+    @staticmethod
+    def _avanzar(con, tabla, cantidad):
+        siguiente, = con.execute(
+            'UPDATE secuencias SET siguiente = siguiente + ? WHERE tabla = ? RETURNING siguiente',
+            (cantidad, tabla)).fetchone()
+        return siguiente - cantidad
+
+    # Con `con` la reserva forma parte de esa transacción
+    def reservar(self, tabla, cantidad, con=None):
+        if con is None:
+            with self.pool.conexion() as con, con:
+                inicio = self._avanzar(con, tabla, cantidad)
+        else:
+            inicio = self._avanzar(con, tabla, cantidad)
+        return [formato_id(tabla, numero) for numero in range(inicio, inicio + cantidad)]
+
+    def nuevo(self, tabla):
+        with self._lock:
+            siguiente, fin = self._reservas.get(tabla, (0, 0))
+            if siguiente == fin:
+                with self.pool.conexion() as con, con:
+                    siguiente = self._avanzar(con, tabla, self.TAMAÑO_RESERVA)
+                fin = siguiente + self.TAMAÑO_RESERVA
+            self._reservas[tabla] = (siguiente + 1, fin)
+            return formato_id(tabla, siguiente)
+
+    # Tras importar ids explícitos con el formato propio, la secuencia
+    # continúa por encima del mayor
+    @staticmethod
+    def respetar(con, tabla, ids):
+        maximo = numero_maximo(tabla, ids)
+        if maximo:
+            con.execute('UPDATE secuencias SET siguiente = MAX(siguiente, ?) WHERE tabla = ?',
+                        (maximo + 1, tabla))
+
+
+# Registro de cambios en SQLite para el modo multiproceso: cada escritura
+# anota (proceso, tabla, id) en la misma transacción y los demás procesos
+# leen las entradas posteriores a la última que vieron. Un id nulo marca
+# un cambio que no se puede seguir fila a fila (importaciones, catálogo).
+class RegistroCambios:
+    PURGAR_CADA = 256
+
+    def __init__(self, pool):
+        self.origen = uuid.uuid4().hex
+        self._escrituras = 0
+        with pool.conexion() as con:
+            self.ultimo = con.execute('SELECT COALESCE(MAX(seq), 0) FROM cambios').fetchone()[0]
+
+    def anotar(self, con, tabla, ids=None):
+        momento = time.time()
+        if ids is None:
+            ids = [None]
+        filas = [(self.origen, tabla, id_registro, momento) for id_registro in ids]
+        con.executemany('INSERT INTO cambios (origen, tabla, registro, momento) VALUES (?, ?, ?, ?)', filas)
+        self._escrituras += 1
+        if self._escrituras % self.PURGAR_CADA == 0:
+            # Siempre queda la última entrada para detectar huecos
+            con.execute('DELETE FROM cambios WHERE momento < ? AND seq < (SELECT MAX(seq) FROM cambios)',
+                        (momento - RETENCION_CAMBIOS,))
+
+    # Cambios de otros procesos desde la última lectura: None si hay que
+    # recargar todo (tabla sin ids o entradas ya purgadas) o un dict
+    # tabla -> ids afectados
+    def pendientes(self, con):
+        primero = con.execute('SELECT MIN(seq) FROM cambios').fetchone()[0]
+        filas = con.execute('SELECT seq, origen, tabla, registro FROM cambios WHERE seq > ? ORDER BY seq',
+                            (self.ultimo,)).fetchall()
+        recargar = primero is not None and primero > self.ultimo + 1
+        cambios = defaultdict(set)
+        for seq, origen, tabla, registro in filas:
+            if origen != self.origen:
+                if registro is None:
+                    recargar = True
+                cambios[tabla].add(registro)
+            self.ultimo = seq
+        return None if recargar else cambios
+
+
+def _escapar_etiqueta(texto):
+    return texto.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# Tiempos por tramo con nombre. Los tramos se anidan por hilo (cada sesión
+# de Streamlit ejecuta el script en el suyo), así que cada medición queda
+# bajo su página y pestaña: 'admin / Reportes / grafico ingresos_periodo'.
+# De cada tramo se guardan las últimas MUESTRAS duraciones para los
+# percentiles. Desactivado, tramo() devuelve siempre el mismo contexto vacío.
+class Perfilador:
+    MUESTRAS = 2048
+    CUANTILES = (0.5, 0.95, 0.99)
+    SEPARADOR = ' / '
+
+    def __init__(self, activo=PERFILADO, ruta=RUTA_METRICAS, intervalo_volcado=10):
+        self.activo = activo
+        self.ruta = ruta
+        self.intervalo_volcado = intervalo_volcado
+        self._volcado = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._muestras = {}
+        self._totales = {}
+        self._nulo = nullcontext()
+
+    def tramo(self, nombre):
+        return self._medir(nombre) if self.activo else self._nulo
+
+    # Ejecuta funcion() dentro de un tramo y devuelve su resultado
+    def medir(self, nombre, funcion):
+        if not self.activo:
+            return funcion()
+        with self._medir(nombre):
+            return funcion()
+
+    @contextmanager
+    def _medir(self, nombre):
+        pila = self._local.__dict__.setdefault('pila', [])
+        pila.append(nombre)
+        ruta = self.SEPARADOR.join(pila)
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracion = time.perf_counter() - inicio
+            pila.pop()
+            with self._lock:
+                muestras = self._muestras.get(ruta)
+                if muestras is None:
+                    muestras = self._muestras[ruta] = deque(maxlen=self.MUESTRAS)
+                    self._totales[ruta] = [0, 0.0]
+                muestras.append(duracion)
+                totales = self._totales[ruta]
+                totales[0] += 1
+                totales[1] += duracion
+
+    def reiniciar(self):
+        with self._lock:
+            self._muestras = {}
+            self._totales = {}
+
+    # Un tramo por fila, del más lento al más rápido según su p95
+    def resumen(self):
+        with self._lock:
+            filas = [(ruta, ruta.split(self.SEPARADOR)[0], llamadas, total,
+                      *np.quantile(np.fromiter(self._muestras[ruta], float), self.CUANTILES))
+                     for ruta, (llamadas, total) in self._totales.items()]
+        frame = pd.DataFrame(filas, columns=['tramo', 'pagina', 'llamadas', 'total', 'p50', 'p95', 'p99'])
+        milisegundos = ['total', 'p50', 'p95', 'p99']
+        frame[milisegundos] = frame[milisegundos] * 1000
+        return frame.rename(columns={c: f'{c}_ms' for c in milisegundos}).sort_values(
+            'p95_ms', ascending=False, ignore_index=True)
+
+    # Exposición en texto de Prometheus: un summary por tramo
+    def texto_prometheus(self):
+        lineas = ['# HELP taller_tramo_segundos Duración de los tramos medidos',
+                  '# TYPE taller_tramo_segundos summary']
+        for fila in self.resumen().itertuples(index=False):
+            etiquetas = f'tramo="{_escapar_etiqueta(fila.tramo)}",pagina="{_escapar_etiqueta(fila.pagina)}"'
+            for cuantil, valor in zip(self.CUANTILES, (fila.p50_ms, fila.p95_ms, fila.p99_ms)):
+                lineas.append(f'taller_tramo_segundos{{{etiquetas},quantile="{cuantil}"}} {valor / 1000:.6f}')
+            lineas.append(f'taller_tramo_segundos_sum{{{etiquetas}}} {fila.total_ms / 1000:.6f}')
+            lineas.append(f'taller_tramo_segundos_count{{{etiquetas}}} {fila.llamadas}')
+        return '\n'.join(lineas) + '\n'
+
+    # Reescribe el archivo de métricas (p. ej. para el textfile collector
+    # de node_exporter) como mucho una vez por intervalo
+    def volcar(self, forzar=False):
+        if not self.activo or not self.ruta:
+            return
+        ahora = time.monotonic()
+        if not forzar and ahora - self._volcado < self.intervalo_volcado:
+            return
+        self._volcado = ahora
+        temporal = f'{self.ruta}.{os.getpid()}.tmp'
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            archivo.write(self.texto_prometheus())
+        os.replace(temporal, self.ruta)
+
+
+# Uno por proceso, como el archivo de métricas que escribe
+PERFILADOR = Perfilador()
+
+
+# Caché LRU compartida por todas las sesiones para resultados derivados
+# caros de construir (p. ej. figuras). Las claves llevan las versiones de
+# las tablas de origen, así que una entrada vieja nunca se vuelve a pedir
+# y termina saliendo por el extremo menos usado.
+class CacheLRU:
+    def __init__(self, capacidad=64):
+        self.capacidad = capacidad
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def obtener(self, clave, construir):
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave)
+                return self._entradas[clave]
+        # Se construye fuera del bloqueo; si dos sesiones coinciden, gana la última
+        valor = construir()
+        with self._lock:
+            self._entradas[clave] = valor
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.capacidad:
+                self._entradas.popitem(last=False)
+        return valor
+
+
+# Pool de conexiones SQLite reutilizables entre hilos de Streamlit
+class PoolConexiones:
+    def __init__(self, ruta, tamaño=4):
+        self.ruta = ruta
+        self._libres = queue.LifoQueue(maxsize=tamaño)
+        for _ in range(tamaño):
+            self._libres.put(None)
+
+    def _abrir(self):
+        # cached_statements mantiene preparadas las sentencias ya usadas
+        con = sqlite3.connect(self.ruta, timeout=30, check_same_thread=False,
+                              cached_statements=256)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        con.execute('PRAGMA foreign_keys=ON')
+        return con
+
+    @contextmanager
+    def conexion(self):
+        con = self._libres.get()
+        if con is None:
+            con = self._abrir()
+        try:
+            yield con
+        finally:
+            self._libres.put(con)
+
+
+# Tabla en memoria de solo-anexar: las filas nuevas se acumulan en una lista
+# (O(1) amortizado) y se compactan en un único pd.concat al leer. Los índices
+# hash se mantienen en cada alta y cambio, así que las búsquedas por clave
+# no necesitan recorrer la tabla.
+class TablaEnMemoria:
+    def __init__(self, nombre, frame):
+        self.nombre = nombre
+        self.columnas = columnas(nombre)
+        self._frame = frame
+        self._pendientes = []
+        self._bloques = []
+        self._longitud = len(frame)
+        natural = CLAVES_DEDUPLICADO.get(nombre)
+        self._normalizar = {natural[0]: natural[1]} if natural else {}
+        self._unicos = {
+            col: dict(zip(frame[col].tolist(), range(len(frame))))
+            for col in INDICES_UNICOS[nombre]
+        }
+        # Los índices múltiples (None hasta entonces) se construyen en la
+        # primera consulta: cargar o importar una tabla no los paga
+        self._multiples = dict.fromkeys(INDICES_MULTIPLES[nombre])
+
+    def __len__(self):
+        return self._longitud
+
+    # Claves de índice de una lista de valores: las de una clave natural se
+    # normalizan y los ausentes quedan como None, que no se indexa
+    def _claves(self, columna, valores):
+        normalizar = self._normalizar.get(columna)
+        if normalizar is None:
+            return valores
+        claves = normalizar(pd.Series(valores, dtype=object))
+        return claves.astype(object).where(claves.notna(), None).tolist()
+
+    def _indexar(self, columna, claves, inicio):
+        indice = self._multiples[columna]
+        for pos, clave in enumerate(claves, inicio):
+            if clave is not None:
+                indice.setdefault(clave, []).append(pos)
+
+    def _indice(self, columna):
+        if self._multiples[columna] is None:
+            self._multiples[columna] = {}
+            self._indexar(columna, self._claves(columna, self.frame()[columna].tolist()), 0)
+        return self._multiples[columna]
+
+    def _reindexar(self, columna, pos, clave_anterior, clave):
+        indice = self._multiples[columna]
+        if indice is None:
+            return
+        if clave_anterior in indice:
+            indice[clave_anterior].remove(pos)
+        if clave is not None:
+            indice.setdefault(clave, []).append(pos)
+
+    def anexar(self, filas):
+        inicio = len(self)
+        for col, indice in self._unicos.items():
+            j = self.columnas.index(col)
+            indice.update(zip((fila[j] for fila in filas), range(inicio, inicio + len(filas))))
+        for col, indice in self._multiples.items():
+            if indice is not None:
+                j = self.columnas.index(col)
+                self._indexar(col, self._claves(col, [fila[j] for fila in filas]), inicio)
+        self._pendientes.extend(filas)
+        self._longitud += len(filas)
+
+    # Anexo de un DataFrame ya tipado (importaciones): los índices se
+    # actualizan por columnas y el bloque se guarda tal cual hasta compactar
+    def anexar_frame(self, bloque):
+        self._cerrar_pendientes()
+        inicio = len(self)
+        for col, indice in self._unicos.items():
+            indice.update(zip(bloque[col].tolist(), range(inicio, inicio + len(bloque))))
+        for col, indice in self._multiples.items():
+            if indice is not None:
+                self._indexar(col, self._claves(col, bloque[col].tolist()), inicio)
+        self._bloques.append(bloque.reset_index(drop=True))
+        self._longitud += len(bloque)
+
+    def _cerrar_pendientes(self):
+        if self._pendientes:
+            self._bloques.append(pd.DataFrame.from_records(self._pendientes, columns=self.columnas))
+            self._pendientes = []
+
+    def _compactar(self):
+        self._cerrar_pendientes()
+        if self._bloques:
+            # Las categorías se unifican contra la tabla en concatenar_tipado
+            categoricas = {c: object for c in self._frame.columns
+                           if isinstance(self._frame[c].dtype, pd.CategoricalDtype)}
+            nuevas = pd.concat([b.astype(categoricas) for b in self._bloques], ignore_index=True)
+            self._frame = concatenar_tipado(self._frame, nuevas)
+            self._bloques = []
+
+    # Vista consistente: todas las filas anexadas hasta este momento
+    def frame(self):
+        self._compactar()
+        return self._frame
+
+    def posicion(self, valor, columna='id'):
+        return self._unicos[columna].get(valor)
+
+    # Posiciones con ese valor; en una clave natural, el valor normalizado
+    def posiciones(self, columna, valor):
+        return self._indice(columna).get(valor, [])
+
+    # Valores distintos de un índice múltiple
+    def claves(self, columna):
+        return self._indice(columna).keys()
+
+    # Máscara de los valores de una Serie que ya existen como clave única
+    def contiene(self, valores, columna='id'):
+        return en_claves(valores, self._unicos[columna])
+
+    # Fila como dict de valores nativos (los escalares numpy de una fila
+    # mixta desbordan al acumularse con enteros grandes)
+    def fila(self, pos):
+        self._compactar()
+        valores = self._frame.iloc[pos].tolist()
+        return {col: v.item() if isinstance(v, np.generic) else v for col, v in zip(self.columnas, valores)}
+
+    # Aplica el cambio y devuelve la fila tal como estaba antes. El frame ya
+    # entregado por frame() no se toca: se escribe en una copia superficial
+    # (con copy-on-write solo se copian las columnas modificadas) que pasa a
+    # ser la tabla.
+    def actualizar(self, id_registro, campos):
+        pos = self.posicion(id_registro)
+        if pos is None:
+            return None
+        anterior = self.fila(pos)
+        frame = self._frame.copy(deep=False)
+        for columna, valor in campos.items():
+            tipo = frame[columna].dtype
+            if isinstance(tipo, pd.CategoricalDtype) and valor not in tipo.categories:
+                frame[columna] = frame[columna].cat.add_categories([valor])
+            j = frame.columns.get_loc(columna)
+            frame.iat[pos, j] = valor
+            if columna in self._unicos:
+                self._unicos[columna].pop(anterior[columna], None)
+                self._unicos[columna][valor] = pos
+            if self._multiples.get(columna) is not None:
+                self._reindexar(columna, pos, *self._claves(columna, [anterior[columna], valor]))
+        self._frame = frame
+        return anterior
+
+    # Igual que actualizar para varias filas a la vez: cada columna se
+    # asigna en una sola operación por posiciones. Cada campo trae un valor
+    # común o una lista con un valor por id. Devuelve las filas anteriores.
+    def actualizar_varios(self, ids, campos):
+        posiciones = [self.posicion(id_registro) for id_registro in ids]
+        anteriores = [self.fila(pos) for pos in posiciones]
+        frame = self._frame.copy(deep=False)
+        for columna, valor in campos.items():
+            valores = valor if isinstance(valor, list) else [valor] * len(posiciones)
+            tipo = frame[columna].dtype
+            if isinstance(tipo, pd.CategoricalDtype):
+                faltan = [v for v in dict.fromkeys(valores) if v not in tipo.categories]
+                if faltan:
+                    frame[columna] = frame[columna].cat.add_categories(faltan)
+            frame.iloc[posiciones, frame.columns.get_loc(columna)] = valores
+            if columna in self._unicos:
+                for pos, anterior, nuevo in zip(posiciones, anteriores, valores):
+                    self._unicos[columna].pop(anterior[columna], None)
+                    self._unicos[columna][nuevo] = pos
+            if self._multiples.get(columna) is not None:
+                claves_anteriores = self._claves(columna, [anterior[columna] for anterior in anteriores])
+                for pos, clave_anterior, clave in zip(posiciones, claves_anteriores, self._claves(columna, valores)):
+                    self._reindexar(columna, pos, clave_anterior, clave)
+        self._frame = frame
+        return anteriores
+
+
+# Agregados del tablero que se mantienen al vuelo: se calculan una vez al
+# cargar cada tabla y después solo se ajustan con cada alta o cambio, de
+# modo que leer cualquier métrica no recorre las tablas.
+class MetricasTaller:
+    def __init__(self):
+        self.citas_por_estado = Counter()
+        self.citas_por_fecha = Counter()
+        self.citas_por_servicio = Counter()
+        self.ingresos_por_servicio = defaultdict(int)
+        self.ingresos_completadas = 0
+
+    def _sumar_cita(self, cita, signo):
+        self.citas_por_estado[cita['estado']] += signo
+        self.citas_por_fecha[cita['fecha']] += signo
+        self.citas_por_servicio[cita['servicio']] += signo
+        self.ingresos_por_servicio[cita['servicio']] += signo * cita['precio']
+        if cita['estado'] == 'Completada':
+            self.ingresos_completadas += signo * cita['precio']
+
+    def cargar(self, tabla, frame):
+        if tabla == 'citas':
+            self.citas_por_estado = Counter(frame['estado'].value_counts().to_dict())
+            self.citas_por_fecha = Counter(frame['fecha'].value_counts().to_dict())
+            self.citas_por_servicio = Counter(frame['servicio'].value_counts().to_dict())
+            self.ingresos_por_servicio = defaultdict(
+                int, frame.groupby('servicio', observed=True)['precio'].sum().to_dict())
+            self.ingresos_completadas = int(frame.loc[frame['estado'] == 'Completada', 'precio'].sum())
+
+    def insertar(self, tabla, filas):
+        if tabla == 'citas':
+            for fila in filas:
+                self._sumar_cita(fila, 1)
+
+    # Alta masiva (importaciones): los mismos ajustes, calculados por columnas
+    def insertar_bloque(self, tabla, frame):
+        if tabla == 'citas':
+            self.citas_por_estado.update(frame['estado'].value_counts().to_dict())
+            self.citas_por_fecha.update(frame['fecha'].value_counts().to_dict())
+            self.citas_por_servicio.update(frame['servicio'].value_counts().to_dict())
+            for servicio, total in frame.groupby('servicio', observed=True)['precio'].sum().items():
+                self.ingresos_por_servicio[servicio] += int(total)
+            self.ingresos_completadas += int(frame.loc[frame['estado'] == 'Completada', 'precio'].sum())
+
+    def actualizar(self, tabla, anterior, campos):
+        if tabla == 'citas':
+            self._sumar_cita(anterior, -1)
+            self._sumar_cita({**anterior, **campos}, 1)
+
+    # Lecturas O(1)
+    def citas_en(self, fecha):
+        return self.citas_por_fecha.get(a_fecha(fecha), 0)
+
+    def citas_con_estado(self, estado):
+        return self.citas_por_estado.get(estado, 0)
+
+    def promedio_completadas(self):
+        completadas = self.citas_con_estado('Completada')
+        return self.ingresos_completadas / completadas if completadas else None
+
+
+# Cubo de citas e ingresos por (día, servicio, cliente, estado). Las altas
+# y cambios se anotan como deltas y se consolidan con un groupby solo al
+# leer, así que los reportes agregan sobre el cubo y no sobre las citas.
+# Comparte el bloqueo del almacén, que es quien le notifica los cambios.
+DIMENSIONES_CUBO = ['fecha', 'servicio', 'cliente_id', 'estado']
+MEDIDAS_CUBO = ['cantidad', 'ingresos']
+
+
+class CuboIngresos:
+    def __init__(self, lock):
+        self._lock = lock
+        self._base = pd.DataFrame(columns=DIMENSIONES_CUBO + MEDIDAS_CUBO)
+        self._bloques = []
+        self._deltas = []
+
+    @staticmethod
+    def _agregar(citas):
+        return (citas[DIMENSIONES_CUBO]
+                .assign(cantidad=1, ingresos=citas['precio'].astype('int64'))
+                .groupby(DIMENSIONES_CUBO, observed=True, dropna=False, as_index=False, sort=False)
+                [MEDIDAS_CUBO].sum())
+
+    def _sumar_cita(self, cita, signo):
+        self._deltas.append(tuple(cita[d] for d in DIMENSIONES_CUBO) + (signo, signo * int(cita['precio'])))
+
+    def cargar(self, tabla, frame):
+        if tabla == 'citas':
+            self._base = self._agregar(frame)
+            self._bloques = []
+            self._deltas = []
+
+    def insertar_bloque(self, tabla, frame):
+        if tabla == 'citas':
+            self._bloques.append(self._agregar(frame))
+
+    def insertar(self, tabla, filas):
+        if tabla == 'citas':
+            for fila in filas:
+                self._sumar_cita(fila, 1)
+
+    def actualizar(self, tabla, anterior, campos):
+        if tabla == 'citas' and {'fecha', 'servicio', 'cliente_id', 'estado', 'precio'} & set(campos):
+            self._sumar_cita(anterior, -1)
+            self._sumar_cita({**anterior, **campos}, 1)
+
+    # Cubo consolidado; las celdas que quedan a cero desaparecen
+    def frame(self):
+        with self._lock:
+            return self._consolidar()
+
+    def _consolidar(self):
+        if self._bloques or self._deltas:
+            partes = [self._base] + self._bloques
+            if self._deltas:
+                partes.append(pd.DataFrame.from_records(self._deltas, columns=DIMENSIONES_CUBO + MEDIDAS_CUBO))
+            texto = {'servicio': object, 'estado': object}
+            cubo = (pd.concat([parte.astype(texto) for parte in partes], ignore_index=True)
+                    .groupby(DIMENSIONES_CUBO, dropna=False, as_index=False, sort=False)[MEDIDAS_CUBO].sum())
+            self._base = cubo[cubo['cantidad'] != 0].reset_index(drop=True)
+            self._bloques = []
+            self._deltas = []
+        return self._base
+
+    def _filtrado(self, estados):
+        cubo = self.frame()
+        return cubo if estados is None else cubo[cubo['estado'].isin(estados)]
+
+    # Citas e ingresos por período ('M' mes, 'W' semana, 'D' día)
+    def por_periodo(self, frecuencia='M', estados=None):
+        cubo = self._filtrado(estados)
+        return cubo.groupby(cubo['fecha'].dt.to_period(frecuencia))[MEDIDAS_CUBO].sum().sort_index()
+
+    def por_servicio(self, estados=None):
+        return (self._filtrado(estados).groupby('servicio')[MEDIDAS_CUBO].sum()
+                .sort_values('cantidad', ascending=False))
+
+    def por_cliente(self, estados=None):
+        return self._filtrado(estados).groupby('cliente_id')[MEDIDAS_CUBO].sum()
+
+
+# Catálogo de servicios: la duración se interpreta una sola vez al dar de
+# alta el servicio, hay índice por nombre y precios/duraciones como arrays
+# para cálculos vectorizados. También guarda la lista de materiales de
+# cada servicio (id de inventario -> unidades que consume).
+class CatalogoServicios:
+    def __init__(self, servicios=()):
+        self.servicios = []
+        self.materiales = {}
+        self._por_nombre = {}
+        self._frame = None
+        for servicio in servicios:
+            self.agregar(servicio['nombre'], servicio['precio'], servicio['duracion'])
+
+    def __len__(self):
+        return len(self.servicios)
+
+    def __iter__(self):
+        return iter(self.servicios)
+
+    def agregar(self, nombre, precio, duracion):
+        servicio = {
+            'nombre': nombre,
+            'precio': int(precio),
+            'duracion': duracion,
+            'minutos': duracion_minutos(duracion),
+        }
+        if nombre in self._por_nombre:
+            self.servicios[self.servicios.index(self._por_nombre[nombre])] = servicio
+        else:
+            self.servicios.append(servicio)
+        self._por_nombre[nombre] = servicio
+        self._frame = None
+        return servicio
+
+    def nombres(self):
+        return [servicio['nombre'] for servicio in self.servicios]
+
+    def buscar(self, nombre):
+        return self._por_nombre.get(nombre)
+
+    def minutos(self, nombre):
+        servicio = self._por_nombre.get(nombre)
+        return servicio['minutos'] if servicio else DURACION_POR_DEFECTO
+
+    # Tabla del catálogo indexada por nombre (se reconstruye solo tras altas)
+    def frame(self):
+        if self._frame is None:
+            self._frame = pd.DataFrame(
+                self.servicios, columns=['nombre', 'precio', 'duracion', 'minutos']
+            ).set_index('nombre')
+        return self._frame
+
+    @property
+    def precios(self):
+        return self.frame()['precio'].to_numpy()
+
+    @property
+    def duraciones(self):
+        return self.frame()['minutos'].to_numpy()
+
+    # Minutos de cada servicio de una Serie, sin recorrerla en Python
+    def minutos_de(self, servicios):
+        minutos = self.frame()['minutos'].reindex(np.asarray(servicios, dtype=object))
+        return minutos.fillna(DURACION_POR_DEFECTO).astype('int64').to_numpy()
+
+    # Unidades de cada item que consumen en total los servicios dados
+    def consumo(self, servicios):
+        total = Counter()
+        for servicio in servicios:
+            total.update(self.materiales.get(servicio, {}))
+        return total
+
+
+# Pronóstico de inventario. El consumo diario de cada item sale de las
+# citas completadas en los últimos DIAS_HISTORIA días multiplicadas por la
+# lista de materiales de su servicio (un producto matricial para todos los
+# items a la vez). Con esa tasa se calcula el punto de reorden (stock
+# mínimo más lo que se gasta mientras llega el pedido) y los días que
+# quedan hasta agotarse. Los items en alerta se guardan en una lista
+# ordenada por esos días, así que contar alertas es O(1) y las k más
+# urgentes se leen en O(k). Comparte el bloqueo del almacén.
+class PronosticoInventario:
+    DIAS_HISTORIA = 90
+    DIAS_REPOSICION = 7
+
+    def __init__(self, catalogo, lock):
+        self.catalogo = catalogo
+        self._lock = lock
+        self._completadas = Counter()
+        self._items = {}
+        self._tasas = {}
+        self._calculado = None
+        self._alertas = []
+        self._clave_alerta = {}
+
+    def _contar_cita(self, cita, signo):
+        if cita['estado'] == EstadoCita.COMPLETADA and not pd.isna(cita['fecha']):
+            self._completadas[(cita['fecha'], cita['servicio'])] += signo
+
+    def _poner_item(self, item):
+        self._items[item['id']] = (item['item'], int(item['stock']), int(item['stock_minimo']))
+        if self._calculado is not None:
+            self._ubicar(item['id'])
+
+    def invalidar(self):
+        self._calculado = None
+
+    # Citas completadas ya contadas por (fecha, servicio), para pronosticar
+    # sin tener las citas en memoria; cargar('citas', ...) las reemplaza
+    def cargar_completadas(self, completadas):
+        self._completadas = completadas
+        self.invalidar()
+
+    def cargar(self, tabla, frame):
+        if tabla == 'citas':
+            completadas = frame[frame['estado'] == EstadoCita.COMPLETADA]
+            self._completadas = Counter(completadas.groupby(['fecha', 'servicio'], observed=True).size().to_dict())
+            self.invalidar()
+        elif tabla == 'inventario':
+            self._items = dict(zip(frame['id'], zip(frame['item'], frame['stock'].tolist(),
+                                                   frame['stock_minimo'].tolist())))
+            self.invalidar()
+
+    def insertar_bloque(self, tabla, frame):
+        if tabla == 'citas':
+            completadas = frame[frame['estado'] == EstadoCita.COMPLETADA]
+            self._completadas.update(completadas.groupby(['fecha', 'servicio'], observed=True).size().to_dict())
+            self.invalidar()
+        elif tabla == 'inventario':
+            self._items.update(zip(frame['id'], zip(frame['item'], frame['stock'].tolist(),
+                                                   frame['stock_minimo'].tolist())))
+            self.invalidar()
+
+    def insertar(self, tabla, filas):
+        for fila in filas:
+            if tabla == 'citas':
+                self._contar_cita(fila, 1)
+            elif tabla == 'inventario':
+                self._poner_item(fila)
+        if tabla == 'citas':
+            self.invalidar()
+
+    def actualizar(self, tabla, anterior, campos):
+        if tabla == 'citas' and {'estado', 'fecha', 'servicio'} & set(campos):
+            self._contar_cita(anterior, -1)
+            self._contar_cita({**anterior, **campos}, 1)
+            self.invalidar()
+        elif tabla == 'inventario' and {'item', 'stock', 'stock_minimo'} & set(campos):
+            self._poner_item({**anterior, **campos})
+
+    # Tasas de consumo de todos los items; se rehacen si cambiaron las
+    # citas completadas o los materiales, o si cambió el día
+    def _recalcular(self):
+        hoy = pd.Timestamp.today().normalize()
+        if self._calculado == hoy:
+            return
+        desde = hoy - pd.Timedelta(days=self.DIAS_HISTORIA)
+        usos = Counter()
+        for (fecha, servicio), cantidad in self._completadas.items():
+            if desde <= fecha <= hoy:
+                usos[servicio] += cantidad
+        materiales = pd.DataFrame(self.catalogo.materiales).fillna(0)
+        usos = pd.Series(usos, dtype='float64').reindex(materiales.columns, fill_value=0)
+        consumo = materiales.to_numpy() @ usos.to_numpy() if len(materiales) else []
+        self._tasas = dict(zip(materiales.index, np.asarray(consumo) / self.DIAS_HISTORIA))
+
+        self._calculado = hoy
+        self._alertas = []
+        self._clave_alerta = {}
+        for item_id in self._items:
+            self._ubicar(item_id)
+
+    def _estado(self, item_id):
+        _, stock, stock_minimo = self._items[item_id]
+        tasa = self._tasas.get(item_id, 0.0)
+        punto_reorden = stock_minimo + int(np.ceil(tasa * self.DIAS_REPOSICION))
+        dias = stock / tasa if tasa > 0 else float('inf')
+        return tasa, punto_reorden, max(dias, 0.0)
+
+    # Coloca un item en la lista de alertas (o lo saca) según su estado actual
+    def _ubicar(self, item_id):
+        clave = self._clave_alerta.pop(item_id, None)
+        if clave is not None:
+            del self._alertas[bisect.bisect_left(self._alertas, clave)]
+        if item_id not in self._items:
+            return
+        _, punto_reorden, dias = self._estado(item_id)
+        if self._items[item_id][1] <= punto_reorden:
+            clave = (dias, item_id)
+            bisect.insort(self._alertas, clave)
+            self._clave_alerta[item_id] = clave
+
+    def total_alertas(self):
+        with self._lock:
+            self._recalcular()
+            return len(self._alertas)
+
+    # Las k alertas más urgentes (o todas): ids de items por días hasta agotarse
+    def alertas(self, k=None):
+        with self._lock:
+            self._recalcular()
+            return [item_id for _, item_id in self._alertas[:k]]
+
+    # Tabla con tasa diaria, punto de reorden y días hasta agotarse
+    def frame(self, ids=None):
+        with self._lock:
+            self._recalcular()
+            ids = list(self._items) if ids is None else ids
+            filas = [(item_id, self._items[item_id][0], self._items[item_id][1], *self._estado(item_id))
+                     for item_id in ids]
+        return pd.DataFrame(filas, columns=['id', 'item', 'stock', 'consumo_diario',
+                                            'punto_reorden', 'dias_hasta_agotar'])
+
+
+class HorarioNoDisponible(Exception):
+    pass
+
+
+# La fila cambió desde que se leyó (otra terminal escribió antes)
+class ConflictoConcurrencia(Exception):
+    pass
+
+
+# Cambio de estado que la máquina de estados no permite
+class TransicionInvalida(Exception):
+    pass
+
+
+# No hay unidades suficientes de algún item para completar las citas
+class StockInsuficiente(Exception):
+    pass
+
+
+# Agenda de bahías: por cada día un entero por bahía usado como mapa de bits
+# de franjas de 15 minutos ocupadas. Comprobar un hueco es un AND por bahía.
+class AgendaTaller:
+    def __init__(self, catalogo, bahias=BAHIAS):
+        self.bahias = bahias
+        self.catalogo = catalogo
+        self._dias = {}
+        self._ocupacion = {}
+        # Citas con sobrecupo (datos antiguos sin bahía libre): no ocupan
+        # ninguna bahía real hasta que se libere un hueco donde quepan
+        self._sobrecupo = {}
+        # Apertura y número de franjas por día de la semana
+        self._franjas = {
+            dia: (a_hora(apertura), int((a_hora(cierre) - a_hora(apertura)) / pd.Timedelta(minutes=MINUTOS_FRANJA)))
+            for dia, (apertura, cierre) in HORARIO_ATENCION.items()
+        }
+
+    def _franjas_dia(self, fecha):
+        return self._franjas.get(fecha.weekday(), (None, 0))
+
+    # Máscara de bits de las franjas que ocupa la cita y si cabe entera
+    # dentro del horario del día (las citas ya existentes se recortan)
+    def _mascara(self, fecha, hora, duracion):
+        apertura, total = self._franjas_dia(fecha)
+        if apertura is None:
+            return 0, False
+        inicio = int((hora - apertura) // pd.Timedelta(minutes=MINUTOS_FRANJA))
+        largo = max(1, -(-int(duracion) // MINUTOS_FRANJA))
+        mascara = self._bits(inicio, largo, total)
+        return mascara, bool(mascara) and inicio >= 0 and inicio + largo <= total
+
+    @staticmethod
+    def _bits(inicio, largo, total):
+        desde, hasta = max(inicio, 0), min(inicio + largo, total)
+        return ((1 << (hasta - desde)) - 1) << desde if hasta > desde else 0
+
+    def _bahia_libre(self, fecha, mascara):
+        dia = self._dias.get(fecha)
+        if dia is None:
+            return 0
+        for bahia, ocupadas in enumerate(dia):
+            if not ocupadas & mascara:
+                return bahia
+        return None
+
+    def _ocupar(self, cita, duracion=None):
+        if cita['estado'] == EstadoCita.CANCELADA or pd.isna(cita['fecha']) or pd.isna(cita['hora']):
+            return
+        fecha = cita['fecha']
+        if duracion is None:
+            duracion = self.catalogo.minutos(cita['servicio'])
+        mascara, _ = self._mascara(fecha, cita['hora'], duracion)
+        self._anotar(cita['id'], fecha, mascara)
+
+    def _anotar(self, id_cita, fecha, mascara):
+        if not mascara:
+            return
+        dia = self._dias.setdefault(fecha, [0] * self.bahias)
+        bahia = self._bahia_libre(fecha, mascara)
+        if bahia is None:
+            self._sobrecupo[id_cita] = (fecha, mascara)
+            return
+        dia[bahia] |= mascara
+        self._ocupacion[id_cita] = (fecha, bahia, mascara)
+
+    # Quita la cita de la agenda; si deja un hueco, las citas con sobrecupo
+    # de ese día que ahora caben pasan a ocuparlo
+    def _liberar(self, id_cita, reubicar=True):
+        self._sobrecupo.pop(id_cita, None)
+        ocupacion = self._ocupacion.pop(id_cita, None)
+        if ocupacion is not None:
+            fecha, bahia, mascara = ocupacion
+            self._dias[fecha][bahia] &= ~mascara
+            if reubicar:
+                for pendiente, (dia, pendiente_mascara) in list(self._sobrecupo.items()):
+                    if dia == fecha and self._bahia_libre(fecha, pendiente_mascara) is not None:
+                        del self._sobrecupo[pendiente]
+                        self._anotar(pendiente, fecha, pendiente_mascara)
+
+    # Igual que _ocupar para muchas citas: las máscaras de bits se calculan
+    # por columnas y solo la elección de bahía se recorre por día
+    def _ocupar_frame(self, frame):
+        activas = frame[((frame['estado'] != EstadoCita.CANCELADA) & frame['fecha'].notna()
+                         & frame['hora'].notna()).to_numpy()]
+        dias = activas['fecha'].dt.weekday
+        apertura = pd.to_timedelta(dias.map({dia: a for dia, (a, _) in self._franjas.items()}))
+        totales = dias.map({dia: t for dia, (_, t) in self._franjas.items()}).fillna(0).astype('int64').to_numpy()
+        inicios = ((activas['hora'] - apertura) // pd.Timedelta(minutes=MINUTOS_FRANJA)).fillna(0).astype('int64').to_numpy()
+        minutos = self.catalogo.minutos_de(activas['servicio'])
+        largos = np.maximum(1, -(-np.asarray(minutos, dtype='int64') // MINUTOS_FRANJA))
+        desde, hasta = np.maximum(inicios, 0), np.minimum(inicios + largos, totales)
+        mascaras = np.where(hasta > desde, ((1 << np.maximum(hasta - desde, 0)) - 1) << desde, 0).tolist()
+        ids = activas['id'].tolist()
+        for fecha, posiciones in activas.groupby('fecha', sort=False).indices.items():
+            fecha = pd.Timestamp(fecha)
+            dia = self._dias.setdefault(fecha, [0] * self.bahias)
+            for pos in posiciones.tolist():
+                mascara = mascaras[pos]
+                if not mascara:
+                    continue
+                for bahia, ocupadas in enumerate(dia):
+                    if not ocupadas & mascara:
+                        dia[bahia] = ocupadas | mascara
+                        self._ocupacion[ids[pos]] = (fecha, bahia, mascara)
+                        break
+                else:
+                    self._sobrecupo[ids[pos]] = (fecha, mascara)
+
+    def cargar(self, tabla, frame):
+        if tabla == 'citas':
+            self._dias = {}
+            self._ocupacion = {}
+            self._sobrecupo = {}
+            self._ocupar_frame(frame)
+
+    def insertar_bloque(self, tabla, frame):
+        if tabla == 'citas':
+            self._ocupar_frame(frame)
+
+    def insertar(self, tabla, filas):
+        if tabla == 'citas':
+            for fila in filas:
+                self._ocupar(fila)
+
+    def actualizar(self, tabla, anterior, campos):
+        if tabla == 'citas' and {'estado', 'fecha', 'hora', 'servicio'} & set(campos):
+            self._liberar(anterior['id'])
+            self._ocupar({**anterior, **campos})
+
+    # Ids de las citas que no caben en sus nuevos horarios, colocándolas en
+    # orden y contando con los huecos que dejan ellas mismas. La agenda
+    # queda como estaba: los cambios llegan después con actualizar().
+    def no_caben(self, citas, nuevos):
+        anteriores = {cita['id']: (self._ocupacion.get(cita['id']), self._sobrecupo.get(cita['id']))
+                      for cita in citas}
+        for cita in citas:
+            self._liberar(cita['id'], reubicar=False)
+        colocadas, fuera = [], []
+        for cita, campos in zip(citas, nuevos):
+            nueva = {**cita, **campos}
+            duracion = self.catalogo.minutos(nueva['servicio'])
+            if self.esta_libre(nueva['fecha'], nueva['hora'], duracion):
+                self._ocupar(nueva, duracion)
+                colocadas.append(cita['id'])
+            else:
+                fuera.append(cita['id'])
+        for id_cita in colocadas:
+            self._liberar(id_cita, reubicar=False)
+        for id_cita, (ocupacion, sobrecupo) in anteriores.items():
+            if ocupacion is not None:
+                fecha, bahia, mascara = ocupacion
+                self._dias[fecha][bahia] |= mascara
+                self._ocupacion[id_cita] = ocupacion
+            if sobrecupo is not None:
+                self._sobrecupo[id_cita] = sobrecupo
+        return fuera
+
+    def esta_libre(self, fecha, hora, duracion):
+        fecha, hora = a_fecha(fecha), a_hora(hora)
+        mascara, cabe = self._mascara(fecha, hora, duracion)
+        if not cabe:
+            return False
+        return self._bahia_libre(fecha, mascara) is not None
+
+    # Horas de HORARIOS_CITA en las que cabe un servicio de esa duración
+    def horarios_libres(self, fecha, duracion):
+        return [hora for hora in HORARIOS_CITA if self.esta_libre(fecha, hora, duracion)]
+
+    # Los n primeros huecos (fecha, hora) a partir de una fecha
+    def siguientes_libres(self, duracion, n, desde=None, dias_maximos=60):
+        fecha = a_fecha(desde or date.today())
+        huecos = []
+        for _ in range(dias_maximos):
+            for hora in self.horarios_libres(fecha, duracion):
+                huecos.append((fecha, hora))
+                if len(huecos) == n:
+                    return huecos
+            fecha += pd.Timedelta(days=1)
+        return huecos
+
+
+_SIN_TILDES = str.maketrans('áéíóúüñàèìòùâêîôûäëïöç', 'aeiouunaeiouaeiouaeioc')
+_NO_ALFANUMERICO = re.compile(r'[^0-9a-z]+')
+
+
+# Minúsculas, sin tildes y con cualquier signo convertido en espacio. Las
+# letras del español se traducen con una tabla; NFKD queda para el resto.
+def normalizar_texto(texto):
+    if texto is None or (isinstance(texto, float) and pd.isna(texto)):
+        return ''
+    texto = str(texto).lower().translate(_SIN_TILDES)
+    if not texto.isascii():
+        descompuesto = unicodedata.normalize('NFKD', texto)
+        texto = ''.join(c for c in descompuesto if not unicodedata.combining(c))
+    return ' '.join(_NO_ALFANUMERICO.sub(' ', texto).split())
+
+
+# Trigramas de un texto ya normalizado. Cada palabra se rellena con dos
+# espacios delante para que también indexe sus prefijos de 1 y 2 letras.
+def trigramas(texto):
+    grams = set()
+    for palabra in texto.split():
+        relleno = '  ' + palabra + ' '
+        grams.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+    return grams
+
+
+# Trigramas de una consulta: las palabras de 3 o más letras buscan en
+# cualquier posición, las más cortas solo como prefijo de palabra
+def trigramas_consulta(texto):
+    grams = set()
+    for palabra in texto.split():
+        if len(palabra) >= 3:
+            grams.update(palabra[i:i + 3] for i in range(len(palabra) - 2))
+        else:
+            relleno = '  ' + palabra
+            grams.update(relleno[i:i + 3] for i in range(len(relleno) - 2))
+    return grams
+
+
+# Índice invertido de trigramas sobre nombre, email, teléfono y placas de
+# cada cliente, más una lista ordenada de teléfonos para buscar por prefijo.
+# Las cargas, altas y cambios se encolan y los aplica un hilo propio en
+# orden, fuera del lock del almacén; buscar espera a que la cola se vacíe.
+class IndiceBusqueda:
+    SIMILITUD_MINIMA = 0.6
+    # Los trigramas presentes en más de esta fracción de los clientes (el
+    # dominio del email, el prefijo de los ids) no generan candidatos
+    FRACCION_COMUN = 0.5
+    MAXIMO_CANDIDATOS = 20_000
+
+    def __init__(self):
+        self._campos = {}
+        self._documentos = {}
+        self._postings = defaultdict(set)
+        self._telefonos = []
+        self._cliente_de_vehiculo = {}
+        self._lock = threading.Lock()
+        self._cola = deque()
+        self._cola_lista = threading.Condition()
+        self._hilo = None
+        self._error = None
+
+    # Encola un cambio; si no hay hilo trabajando se arranca uno, que
+    # termina en cuanto la cola queda vacía
+    def _encolar(self, tarea, *argumentos):
+        with self._cola_lista:
+            self._cola.append((tarea, argumentos))
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._trabajar, name='indice-busqueda', daemon=True)
+                self._hilo.start()
+
+    def _trabajar(self):
+        while True:
+            with self._cola_lista:
+                if not self._cola:
+                    self._hilo = None
+                    self._cola_lista.notify_all()
+                    return
+                tarea, argumentos = self._cola.popleft()
+            try:
+                with self._lock, PERFILADOR.tramo('indice de búsqueda'):
+                    tarea(*argumentos)
+            except Exception as error:
+                self._error = error
+
+    # Espera a que se hayan aplicado todos los cambios encolados. Si alguno
+    # falló el índice queda incompleto y cada búsqueda vuelve a fallar
+    # hasta que el almacén lo reconstruye.
+    def esperar(self):
+        with self._cola_lista:
+            while self._hilo is not None:
+                self._cola_lista.wait()
+        if self._error is not None:
+            raise self._error
+
+    def _reindexar(self, cliente_id):
+        campos = self._campos[cliente_id]
+        documento = normalizar_texto(' '.join(
+            [campos['nombre'], campos['email'], campos['telefono']] + sorted(campos['placas'])))
+        nuevos = trigramas(documento)
+        # Los trigramas anteriores salen del documento guardado, sin
+        # conservar un conjunto por cliente
+        anterior = self._documentos.get(cliente_id)
+        if anterior:
+            anteriores = trigramas(anterior)
+            for gram in anteriores - nuevos:
+                self._postings[gram].discard(cliente_id)
+            nuevos_grams = nuevos - anteriores
+        else:
+            nuevos_grams = nuevos
+        for gram in nuevos_grams:
+            self._postings[gram].add(cliente_id)
+        self._documentos[cliente_id] = documento
+
+    def _campos_cliente(self, cliente_id):
+        return self._campos.setdefault(
+            cliente_id, {'nombre': '', 'email': '', 'telefono': '', 'placas': set()})
+
+    # Con en_bloque=True el teléfono se añade al final y quien llama
+    # reordena la lista una sola vez
+    def _poner_cliente(self, cliente, en_bloque=False):
+        campos = self._campos_cliente(cliente['id'])
+        telefono_anterior = re.sub(r'\D', '', campos['telefono'])
+        if telefono_anterior:
+            i = bisect.bisect_left(self._telefonos, (telefono_anterior, cliente['id']))
+            if i < len(self._telefonos) and self._telefonos[i] == (telefono_anterior, cliente['id']):
+                del self._telefonos[i]
+        for campo in ('nombre', 'email', 'telefono'):
+            valor = cliente.get(campo)
+            campos[campo] = '' if valor is None or pd.isna(valor) else str(valor)
+        telefono = re.sub(r'\D', '', campos['telefono'])
+        if telefono and en_bloque:
+            self._telefonos.append((telefono, cliente['id']))
+        elif telefono:
+            bisect.insort(self._telefonos, (telefono, cliente['id']))
+        self._reindexar(cliente['id'])
+
+    def _poner_vehiculo(self, vehiculo, anterior=None):
+        if anterior is not None:
+            cliente_anterior = self._cliente_de_vehiculo.pop(anterior['id'], None)
+            if cliente_anterior in self._campos:
+                self._campos[cliente_anterior]['placas'].discard(str(anterior['placa']))
+                self._reindexar(cliente_anterior)
+        placa = vehiculo.get('placa')
+        if placa is None or pd.isna(placa):
+            return
+        self._cliente_de_vehiculo[vehiculo['id']] = vehiculo['cliente_id']
+        self._campos_cliente(vehiculo['cliente_id'])['placas'].add(str(placa))
+        self._reindexar(vehiculo['cliente_id'])
+
+    # Los trigramas se calculan por palabra, así que una placa nueva en un
+    # cliente ya indexado solo añade los suyos al documento; los clientes aún
+    # sin documento se reindexan una sola vez al final del bloque
+    def _poner_vehiculos(self, vehiculos):
+        afectados = set()
+        for vehiculo in vehiculos:
+            placa = vehiculo['placa']
+            if placa is None or pd.isna(placa):
+                continue
+            cliente_id = vehiculo['cliente_id']
+            self._cliente_de_vehiculo[vehiculo['id']] = cliente_id
+            placas = self._campos_cliente(cliente_id)['placas']
+            if str(placa) in placas:
+                continue
+            placas.add(str(placa))
+            documento = self._documentos.get(cliente_id)
+            if documento is None or cliente_id in afectados:
+                afectados.add(cliente_id)
+                continue
+            palabra = normalizar_texto(str(placa))
+            self._documentos[cliente_id] = f'{documento} {palabra}' if documento else palabra
+            for gram in trigramas(palabra):
+                self._postings[gram].add(cliente_id)
+        for cliente_id in afectados:
+            self._reindexar(cliente_id)
+
+    def _poner_clientes(self, clientes):
+        for cliente in clientes:
+            self._poner_cliente(cliente, en_bloque=True)
+        self._telefonos.sort()
+
+    def cargar(self, tabla, frame):
+        self.insertar_bloque(tabla, frame)
+
+    # Las columnas se copian aquí, con el lock del almacén, y el hilo del
+    # índice trabaja sobre esas listas
+    def insertar_bloque(self, tabla, frame):
+        if tabla == 'clientes':
+            campos = ['id', 'nombre', 'email', 'telefono']
+        elif tabla == 'vehiculos':
+            campos = ['id', 'cliente_id', 'placa']
+        else:
+            return
+        filas = [dict(zip(campos, valores)) for valores in zip(*(frame[c].tolist() for c in campos))]
+        self.insertar(tabla, filas)
+
+    def insertar(self, tabla, filas):
+        if tabla == 'clientes':
+            self._encolar(self._poner_clientes, list(filas))
+        elif tabla == 'vehiculos':
+            self._encolar(self._poner_vehiculos, list(filas))
+
+    def actualizar(self, tabla, anterior, campos):
+        if tabla == 'clientes' and {'nombre', 'email', 'telefono'} & set(campos):
+            self._encolar(self._poner_cliente, {**anterior, **campos})
+        elif tabla == 'vehiculos' and {'placa', 'cliente_id'} & set(campos):
+            self._encolar(self._poner_vehiculo, {**anterior, **campos}, anterior)
+
+    # Ids de clientes que coinciden, del más al menos relevante: primero los
+    # que empiezan por el teléfono buscado, luego los que contienen la
+    # consulta completa y después por proporción de trigramas compartidos
+    def buscar(self, texto, limite=50):
+        consulta = normalizar_texto(texto)
+        if not consulta:
+            return []
+        self.esperar()
+        with self._lock:
+            return self._buscar(texto, consulta, limite)
+
+    def _buscar(self, texto, consulta, limite):
+        puntajes = {}
+        digitos = re.sub(r'[\s()+-]', '', str(texto))
+        if len(digitos) >= 3 and digitos.isdigit():
+            i = bisect.bisect_left(self._telefonos, (digitos, ''))
+            while (i < len(self._telefonos) and len(puntajes) < limite
+                   and self._telefonos[i][0].startswith(digitos)):
+                puntajes[self._telefonos[i][1]] = (2, 1.0)
+                i += 1
+            if len(puntajes) >= limite:
+                return list(puntajes)
+
+        # Las listas raras se mezclan contando cuántos de sus trigramas tiene
+        # cada cliente, y solo pasan quienes aún pueden llegar a la similitud
+        # mínima. Si son demasiados se puntúan los que más trigramas
+        # comparten. Las listas comunes no aportan candidatos y se consultan
+        # por pertenencia.
+        listas = sorted((self._postings.get(gram, set()) for gram in trigramas_consulta(consulta)), key=len)
+        necesarias = -(-int(len(listas) * self.SIMILITUD_MINIMA * 100) // 100)
+        raras = [lista for lista in listas if len(lista) <= self.FRACCION_COMUN * len(self._documentos)]
+        comunes = listas[len(raras):]
+        if raras:
+            aciertos = Counter()
+            for lista in raras:
+                aciertos.update(lista)
+            necesarias_raras = max(1, necesarias - len(comunes))
+            candidatos = [cliente_id for cliente_id, n in aciertos.items() if n >= necesarias_raras]
+            if len(candidatos) > self.MAXIMO_CANDIDATOS:
+                candidatos = heapq.nlargest(self.MAXIMO_CANDIDATOS, candidatos, key=aciertos.__getitem__)
+        else:
+            # Todos los trigramas son comunes: cualquier cliente de la lista
+            # más corta comparte tantos como el resto
+            aciertos = Counter()
+            candidatos = itertools.islice(listas[0], self.MAXIMO_CANDIDATOS)
+        for cliente_id in candidatos:
+            if cliente_id in puntajes:
+                continue
+            similitud = (aciertos[cliente_id] + sum(cliente_id in lista for lista in comunes)) / len(listas)
+            if similitud >= self.SIMILITUD_MINIMA:
+                exacta = int(consulta in self._documentos[cliente_id])
+                puntajes[cliente_id] = (exacta, similitud)
+
+        mejores = heapq.nlargest(limite, puntajes.items(), key=lambda item: item[1])
+        return [cliente_id for cliente_id, _ in mejores]
+
+
+# Importación y exportación masiva. Los archivos se leen por bloques de
+# filas como texto y cada bloque se valida y tipa con aplicar_esquema; nada
+# se recorre fila a fila en Python. Parquet necesita pyarrow (opcional).
+FORMATOS_DATOS = ('csv', 'parquet')
+TAMAÑO_BLOQUE = 50_000
+
+# Claves foráneas y la tabla a la que apuntan
+REFERENCIAS = {'cliente_id': 'clientes', 'vehiculo_id': 'vehiculos'}
+
+# Columnas que no pueden quedar vacías en una fila importada (las claves
+# foráneas se comprueban aparte, contra la tabla a la que apuntan)
+OBLIGATORIAS = {
+    tabla: [nombre for nombre, tipo in definicion
+            if ('NOT NULL' in tipo or 'PRIMARY KEY' in tipo) and nombre not in REFERENCIAS]
+    for tabla, definicion in ESQUEMAS.items()
+}
+# Una cita sin estado no podría volver a cambiar de estado
+OBLIGATORIAS['citas'].append('estado')
+
+# Claves naturales que no se pueden repetir, con su forma normalizada
+CLAVES_DEDUPLICADO = {
+    'clientes': ('email', lambda serie: serie.str.strip().str.lower()),
+    'vehiculos': ('placa', lambda serie: serie.str.upper().str.replace(r'[\s-]', '', regex=True)),
+}
+
+
+def _parquet():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as error:
+        raise ImportError('Para leer o escribir Parquet hace falta pyarrow (pip install pyarrow)') from error
+    return pa, pq
+
+
+# Bloques de filas de un CSV o Parquet (ruta o archivo abierto)
+def leer_por_bloques(fuente, formato='csv', tamaño_bloque=TAMAÑO_BLOQUE):
+    if formato == 'csv':
+        yield from pd.read_csv(fuente, dtype=str, keep_default_na=False, na_values=[''],
+                               chunksize=tamaño_bloque)
+    elif formato == 'parquet':
+        _, pq = _parquet()
+        for lote in pq.ParquetFile(fuente).iter_batches(batch_size=tamaño_bloque):
+            yield lote.to_pandas()
+    else:
+        raise ValueError(f'Formato no soportado: {formato}')
+
+
+# Lleva un bloque tipado a la representación de SQLite: fechas y horas como
+# texto ISO, categorías como texto y valores ausentes como None
+def a_texto_sql(tabla, frame):
+    salida = {}
+    for columna in columnas(tabla):
+        serie = frame[columna]
+        tipo = TIPOS[tabla].get(columna)
+        if tipo == 'fecha':
+            serie = serie.dt.strftime('%Y-%m-%d')
+        elif tipo == 'hora':
+            serie = textos_hora(serie).where(serie.notna())
+        salida[columna] = serie.astype(object).where(serie.notna(), None)
+    return pd.DataFrame(salida)
+
+
+# Repositorio compartido por todas las sesiones del proceso
+class AlmacenTaller:
+    def __init__(self, ruta=RUTA_POR_DEFECTO, tamaño_pool=4, compartido=MODO_COMPARTIDO):
+        self.pool = PoolConexiones(ruta, tamaño_pool)
+        self._lock = threading.RLock()
+        self._tablas = {}
+        self._versiones = {}
+        self._vistas = {}
+        self._derivados = CacheLRU()
+        self.perfilador = PERFILADOR
+        # SQL generado una sola vez por tabla para reutilizar la sentencia preparada
+        self._sql_select = {
+            tabla: 'SELECT {} FROM "{}" ORDER BY rowid'.format(
+                ', '.join(f'"{c}"' for c in columnas(tabla)), tabla)
+            for tabla in ESQUEMAS
+        }
+        self._sql_insert = {
+            tabla: 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                tabla,
+                ', '.join(f'"{c}"' for c in columnas(tabla)),
+                ', '.join('?' for _ in columnas(tabla)))
+            for tabla in ESQUEMAS
+        }
+        self._crear_esquema()
+        self.ids = GeneradorIds(self.pool)
+        self.cambios = RegistroCambios(self.pool) if compartido else None
+        self._sincronizado = time.monotonic()
+        self._completadas_sql = False
+        self.catalogo = self._cargar_catalogo()
+        self._crear_observadores()
+
+    # Consumidores incrementales notificados en cada carga, alta y cambio
+    def _crear_observadores(self):
+        self._observadores = []
+        self.metricas_taller = MetricasTaller()
+        self.registrar(self.metricas_taller)
+        self.cubo_ingresos = CuboIngresos(self._lock)
+        self.registrar(self.cubo_ingresos)
+        self.agenda_taller = AgendaTaller(self.catalogo)
+        self.registrar(self.agenda_taller)
+        self.indice_busqueda = IndiceBusqueda()
+        self.registrar(self.indice_busqueda)
+        self.pronostico_inventario = PronosticoInventario(self.catalogo, self._lock)
+        self.registrar(self.pronostico_inventario)
+
+    def _crear_esquema(self):
+        with self.pool.conexion() as con, con:
+            for tabla, definicion in ESQUEMAS.items():
+                cols = ', '.join(f'"{nombre}" {tipo}' for nombre, tipo in definicion)
+                con.execute(f'CREATE TABLE IF NOT EXISTS "{tabla}" ({cols})')
+                # Bases anteriores: se añaden las columnas que falten
+                existentes = {fila[1] for fila in con.execute(f'PRAGMA table_info("{tabla}")')}
+                for nombre, tipo in definicion:
+                    if nombre not in existentes:
+                        con.execute(f'ALTER TABLE "{tabla}" ADD COLUMN "{nombre}" {tipo}')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_vehiculos_cliente ON vehiculos(cliente_id)')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_citas_fecha ON citas(fecha)')
+
+            con.execute('CREATE TABLE IF NOT EXISTS servicios '
+                        '(nombre TEXT PRIMARY KEY, precio INTEGER, duracion TEXT)')
+            con.execute('CREATE TABLE IF NOT EXISTS secuencias '
+                        '(tabla TEXT PRIMARY KEY, siguiente INTEGER NOT NULL)')
+            con.execute('CREATE TABLE IF NOT EXISTS cambios '
+                        '(seq INTEGER PRIMARY KEY AUTOINCREMENT, origen TEXT NOT NULL, '
+                        'tabla TEXT NOT NULL, registro TEXT, momento REAL NOT NULL)')
+            # Registro de solo-anexar de los cambios de estado de cada cita;
+            # la columna citas.estado es su proyección
+            con.execute('CREATE TABLE IF NOT EXISTS eventos_cita '
+                        '(seq INTEGER PRIMARY KEY AUTOINCREMENT, cita_id TEXT NOT NULL, '
+                        'desde TEXT, hacia TEXT NOT NULL, momento TEXT NOT NULL)')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_eventos_cita ON eventos_cita(cita_id, seq)')
+            con.execute(SQL_REPRODUCIR_ESTADOS)
+            con.execute('CREATE TABLE IF NOT EXISTS materiales_servicio '
+                        '(servicio TEXT NOT NULL, item_id TEXT NOT NULL REFERENCES inventario(id), '
+                        'cantidad INTEGER NOT NULL, PRIMARY KEY (servicio, item_id))')
+
+            vacia = con.execute('SELECT COUNT(*) FROM clientes').fetchone()[0] == 0
+            if vacia:
+                for tabla, filas in _datos_semilla().items():
+                    con.executemany(self._sql_insert[tabla], filas)
+                con.executemany('INSERT INTO materiales_servicio VALUES (?, ?, ?)',
+                                [(servicio, item_id, cantidad)
+                                 for servicio, materiales in MATERIALES_INICIALES.items()
+                                 for item_id, cantidad in materiales.items()])
+            con.execute(SQL_EVENTOS_ALTA, (datetime.now().isoformat(timespec='seconds'),))
+            if con.execute('SELECT COUNT(*) FROM servicios').fetchone()[0] == 0:
+                con.executemany('INSERT INTO servicios VALUES (?, ?, ?)',
+                                [(s['nombre'], s['precio'], s['duracion']) for s in SERVICIOS_INICIALES])
+            # Las secuencias nuevas arrancan por encima de los ids propios existentes
+            for tabla, prefijo in PREFIJOS_ID.items():
+                maximo = con.execute(f'SELECT MAX(id) FROM "{tabla}" WHERE id GLOB ?',
+                                     (prefijo + '[0-9]' * DIGITOS_ID,)).fetchone()[0]
+                siguiente = int(maximo[len(prefijo):]) + 1 if maximo else 1
+                con.execute('INSERT OR IGNORE INTO secuencias VALUES (?, ?)', (tabla, siguiente))
+
+    def _cargar_catalogo(self):
+        with self.pool.conexion() as con:
+            filas = con.execute('SELECT nombre, precio, duracion FROM servicios ORDER BY rowid').fetchall()
+            materiales = con.execute('SELECT servicio, item_id, cantidad FROM materiales_servicio').fetchall()
+        catalogo = CatalogoServicios(
+            {'nombre': nombre, 'precio': precio, 'duracion': duracion} for nombre, precio, duracion in filas
+        )
+        for servicio, item_id, cantidad in materiales:
+            catalogo.materiales.setdefault(servicio, {})[item_id] = cantidad
+        return catalogo
+
+    def agregar_servicio(self, nombre, precio, duracion):
+        with self._lock:
+            with self._escritura() as con:
+                con.execute('INSERT OR REPLACE INTO servicios VALUES (?, ?, ?)',
+                            (nombre, _a_sql(precio), duracion))
+                self._anotar(con, 'servicios')
+            servicio = self.catalogo.agregar(nombre, precio, duracion)
+            self._versiones['servicios'] = self.version('servicios') + 1
+            return servicio
+
+    # Reemplaza la lista de materiales de un servicio
+    def definir_materiales(self, servicio, materiales):
+        materiales = {item_id: int(cantidad) for item_id, cantidad in materiales.items() if cantidad}
+        with self._lock:
+            with self._escritura() as con:
+                con.execute('DELETE FROM materiales_servicio WHERE servicio = ?', (servicio,))
+                con.executemany('INSERT INTO materiales_servicio VALUES (?, ?, ?)',
+                                [(servicio, item_id, cantidad) for item_id, cantidad in materiales.items()])
+                self._anotar(con, 'servicios')
+            self.catalogo.materiales[servicio] = materiales
+            self.pronostico_inventario.invalidar()
+            self._versiones['servicios'] = self.version('servicios') + 1
+
+    def version(self, tabla):
+        return self._versiones.get(tabla, 0)
+
+    # Transacción de escritura. En modo compartido toma el bloqueo de
+    # escritura de SQLite antes de leer nada (BEGIN IMMEDIATE) y aplica los
+    # cambios de otros procesos, así las comprobaciones de quien escribe
+    # (p. ej. bahía libre) valen también entre procesos. Con
+    # claves_foraneas=False SQLite no revisa las referencias: solo para
+    # quien ya las comprobó contra las tablas en memoria (importar).
+    @contextmanager
+    def _escritura(self, claves_foraneas=True):
+        with self.pool.conexion() as con:
+            if not claves_foraneas:
+                con.execute('PRAGMA foreign_keys=OFF')
+            try:
+                with con:
+                    if self.cambios is not None:
+                        con.execute('BEGIN IMMEDIATE')
+                        self._sincronizar(con)
+                    yield con
+            finally:
+                if not claves_foraneas:
+                    con.execute('PRAGMA foreign_keys=ON')
+
+    def _anotar(self, con, tabla, ids=None):
+        if self.cambios is not None:
+            self.cambios.anotar(con, tabla, ids)
+
+    # Trae los cambios de otros procesos, como mucho una vez por intervalo
+    def sincronizar(self, forzar=False):
+        if self.cambios is None:
+            return
+        if not forzar and time.monotonic() - self._sincronizado < INTERVALO_SINCRONIZACION:
+            return
+        with self._lock:
+            with self.pool.conexion() as con, self.perfilador.tramo('sincronizar'):
+                self._sincronizar(con)
+
+    def _sincronizar(self, con):
+        self._sincronizado = time.monotonic()
+        cambios = self.cambios.pendientes(con)
+        if cambios is None:
+            self._recargar()
+            return
+        for tabla, ids in cambios.items():
+            if tabla in self._tablas:
+                self._traer(con, tabla, ids)
+            elif tabla == 'citas':
+                self._completadas_sql = False
+
+    # Relee de SQLite las filas cambiadas por otro proceso: las que faltan
+    # se dan de alta y en las demás se reflejan solo los campos distintos
+    def _traer(self, con, tabla, ids):
+        memoria = self._tablas[tabla]
+        consulta = self._sql_select[tabla].replace(' ORDER BY', ' WHERE id IN ({}) ORDER BY')
+        ids = list(ids)
+        nuevas = []
+        for inicio in range(0, len(ids), 500):
+            lote = ids[inicio:inicio + 500]
+            for fila in con.execute(consulta.format(', '.join('?' * len(lote))), lote):
+                registro = normalizar_registro(tabla, dict(zip(memoria.columnas, fila)))
+                pos = memoria.posicion(registro['id'])
+                if pos is None:
+                    nuevas.append(registro)
+                    continue
+                anterior = memoria.fila(pos)
+                distintos = {c: v for c, v in registro.items()
+                             if not (v == anterior[c] or (pd.isna(v) and pd.isna(anterior[c])))}
+                if distintos:
+                    self._reflejar(tabla, registro['id'], distintos)
+        if nuevas:
+            memoria.anexar([tuple(r.values()) for r in nuevas])
+            for observador in self._observadores:
+                observador.insertar(tabla, nuevas)
+        self._versiones[tabla] = self.version(tabla) + 1
+
+    # Descarta todo el estado en memoria; las tablas se vuelven a leer de
+    # SQLite la próxima vez que se pidan
+    def _recargar(self):
+        self._tablas = {}
+        self._vistas = {}
+        self._completadas_sql = False
+        self.catalogo = self._cargar_catalogo()
+        self._crear_observadores()
+        for tabla in list(ESQUEMAS) + ['servicios']:
+            self._versiones[tabla] = self.version(tabla) + 1
+
+    def registrar(self, observador):
+        with self._lock:
+            self._observadores.append(observador)
+            for tabla, memoria in self._tablas.items():
+                observador.cargar(tabla, memoria.frame())
+
+    def _tabla_memoria(self, tabla):
+        memoria = self._tablas.get(tabla)
+        if memoria is None:
+            with self.pool.conexion() as con, self.perfilador.tramo(f'cargar {tabla}'):
+                frame = aplicar_esquema(tabla, pd.read_sql_query(self._sql_select[tabla], con))
+            memoria = self._tablas[tabla] = TablaEnMemoria(tabla, frame)
+            for observador in self._observadores:
+                observador.cargar(tabla, frame)
+        return memoria
+
+    # Agenda de bahías con las citas ya cargadas
+    def agenda(self):
+        with self._lock:
+            self._tabla_memoria('citas')
+            return self.agenda_taller
+
+    # Reserva atómica: comprueba el hueco y da de alta la cita bajo el mismo
+    # bloqueo, así dos puestos no pueden ocupar la misma bahía a la vez
+    def agendar_cita(self, registro):
+        with self._lock:
+            with self._escritura() as con:
+                agenda = self.agenda()
+                duracion = self.catalogo.minutos(registro['servicio'])
+                if not agenda.esta_libre(registro['fecha'], registro['hora'], duracion):
+                    raise HorarioNoDisponible(
+                        f"No hay bahías libres el {a_fecha(registro['fecha']):%d/%m/%Y} "
+                        f"a las {registro['hora']}")
+                nuevas = self._escribir_altas(con, 'citas', [registro])
+            self._aplicar_altas('citas', nuevas)
+
+    # Métricas del tablero con las citas ya cargadas
+    def metricas(self):
+        with self._lock:
+            self._tabla_memoria('citas')
+            return self.metricas_taller
+
+    # Pronóstico de inventario con el inventario cargado. Si las citas aún
+    # no están en memoria, las completadas se cuentan con un GROUP BY en
+    # SQLite en lugar de cargar la tabla entera.
+    def pronostico(self):
+        with self._lock:
+            self._tabla_memoria('inventario')
+            if 'citas' not in self._tablas and not self._completadas_sql:
+                with self.pool.conexion() as con, self.perfilador.tramo('contar completadas'):
+                    conteo = pd.read_sql_query(
+                        'SELECT fecha, servicio, COUNT(*) AS n FROM citas '
+                        'WHERE estado = ? AND fecha IS NOT NULL GROUP BY fecha, servicio',
+                        con, params=(EstadoCita.COMPLETADA.value,))
+                conteo['fecha'] = pd.to_datetime(conteo['fecha'], errors='coerce').dt.normalize()
+                self.pronostico_inventario.cargar_completadas(
+                    Counter(conteo.dropna(subset=['fecha']).groupby(['fecha', 'servicio'])['n'].sum().to_dict()))
+                self._completadas_sql = True
+            return self.pronostico_inventario
+
+    # Número de filas, sin cargar la tabla si aún no está en memoria
+    def contar(self, tabla):
+        with self._lock:
+            memoria = self._tablas.get(tabla)
+            if memoria is not None:
+                return len(memoria)
+            with self.pool.conexion() as con:
+                return con.execute(f'SELECT COUNT(*) FROM "{tabla}"').fetchone()[0]
+
+    # Citas de un día: de las métricas si las citas están cargadas y si no
+    # con el índice por fecha de SQLite
+    def citas_en(self, fecha):
+        with self._lock:
+            if 'citas' in self._tablas:
+                return self.metricas_taller.citas_en(fecha)
+            with self.pool.conexion() as con:
+                return con.execute('SELECT COUNT(*) FROM citas WHERE fecha = ?',
+                                   (_a_sql(a_fecha(fecha)),)).fetchone()[0]
+
+    # Nombre de cada cliente por id, para listas de selección
+    def nombres_clientes(self):
+        def construir():
+            clientes = self.tabla('clientes')
+            return dict(zip(clientes['id'].tolist(), clientes['nombre'].tolist()))
+        return self._vista('nombres_clientes', ['clientes'], construir)
+
+    # Nombre de cada item de inventario por id, para listas de selección
+    def nombres_inventario(self):
+        def construir():
+            inventario = self.tabla('inventario')
+            return dict(zip(inventario['id'].tolist(), inventario['item'].tolist()))
+        return self._vista('nombres_inventario', ['inventario'], construir)
+
+    # Cubo de ingresos con las citas ya cargadas
+    def cubo(self):
+        with self._lock:
+            self._tabla_memoria('citas')
+            return self.cubo_ingresos
+
+    # Los n clientes con más citas, con su nombre resuelto en un solo merge
+    def clientes_frecuentes(self, n=10, estados=None):
+        with self._lock:
+            conteo = self.cubo().por_cliente(estados)['cantidad'].nlargest(n)
+            clientes = self.tabla('clientes')[['id', 'nombre']].rename(columns={'id': 'cliente_id'})
+            return conteo.reset_index().merge(clientes, on='cliente_id', how='left')
+
+    # Lectura: DataFrame compartido, no debe modificarse en el llamador
+    def tabla(self, tabla):
+        with self._lock:
+            return self._tabla_memoria(tabla).frame()
+
+    # Resultado derivado de unas tablas (figuras, resúmenes) cacheado por
+    # (tipo, parámetros, versiones) en una LRU común a todas las sesiones
+    def derivado(self, tipo, parametros, tablas, construir):
+        clave = (tipo, parametros, tuple(self.version(t) for t in tablas))
+        return self._derivados.obtener(clave, lambda: self.perfilador.medir(f'derivado {tipo}', construir))
+
+    # Vista derivada cacheada mientras no cambie la versión de sus tablas
+    def _vista(self, nombre, tablas, construir):
+        with self._lock:
+            clave = tuple(self.version(t) for t in tablas)
+            cacheada = self._vistas.get(nombre)
+            if cacheada is None or cacheada[0] != clave:
+                cacheada = self._vistas[nombre] = (clave, self.perfilador.medir(f'vista {nombre}', construir))
+            return cacheada[1]
+
+    # Citas unidas con su cliente y vehículo en un solo merge vectorizado,
+    # ordenadas por (fecha, hora, id) para paginar por clave
+    def vista_citas(self):
+        def construir():
+            clientes = self.tabla('clientes')[['id', 'nombre']].rename(
+                columns={'id': 'cliente_id', 'nombre': 'cliente_nombre'})
+            vehiculos = self.tabla('vehiculos')[['id', 'marca', 'modelo', 'placa']].rename(
+                columns={'id': 'vehiculo_id'})
+            vista = (self.tabla('citas')
+                     .merge(clientes, on='cliente_id', how='left')
+                     .merge(vehiculos, on='vehiculo_id', how='left'))
+            vista['vehiculo'] = (vista['marca'].astype(str) + ' ' + vista['modelo'].astype(str)
+                                 + ' (' + vista['placa'].astype(str) + ')')
+            vista['fecha_texto'] = vista['fecha'].dt.strftime('%Y-%m-%d')
+            vista['hora_texto'] = textos_hora(vista['hora'])
+            vista['clave_orden'] = (vista['fecha_texto'] + ' ' + vista['hora_texto']
+                                    + ' ' + vista['id'].astype(str))
+            return vista.sort_values('clave_orden', ignore_index=True)
+
+        return self._vista('citas', ('citas', 'clientes', 'vehiculos'), construir)
+
+    # Inventario para mostrar: sin la columna interna 'version' y con el
+    # estado del stock calculado por columnas. Se construye una vez por
+    # versión del inventario y se comparte entre sesiones (solo lectura).
+    def vista_inventario(self):
+        def construir():
+            inventario = self.tabla('inventario')
+            estado = np.where(inventario['stock'] <= inventario['stock_minimo'], '🔴 Stock Bajo', '✅ OK')
+            return inventario.drop(columns='version').assign(
+                Estado=pd.Categorical(estado, categories=['🔴 Stock Bajo', '✅ OK']))
+
+        return self._vista('inventario', ('inventario',), construir)
+
+    # Posiciones de cada estado en la vista de citas, ordenadas
+    def _posiciones_por_estado(self):
+        def construir():
+            grupos = self.vista_citas().groupby('estado', observed=True, sort=False).indices
+            return {str(estado): posiciones for estado, posiciones in grupos.items()}
+
+        return self._vista('citas_por_estado', ('citas', 'clientes', 'vehiculos'), construir)
+
+    # Consulta componible sobre la vista de citas (ver ConsultaCitas)
+    def consultar_citas(self):
+        with self._lock:
+            return ConsultaCitas(self.vista_citas(), self._posiciones_por_estado())
+
+    # Consultas por rango de fechas sobre la vista ordenada: dos búsquedas
+    # binarias delimitan el tramo, sin máscaras sobre toda la columna
+    def citas_entre(self, desde, hasta):
+        vista = self.vista_citas()
+        fechas = vista['fecha']
+        inicio = fechas.searchsorted(a_fecha(desde), side='left')
+        fin = fechas.searchsorted(a_fecha(hasta), side='right')
+        return vista.iloc[inicio:fin]
+
+    # Las n siguientes citas desde una fecha con alguno de los estados dados;
+    # se revisan tramos crecientes a partir de la posición de la fecha
+    def proximas_citas(self, n, estados, desde=None):
+        vista = self.vista_citas()
+        inicio = vista['fecha'].searchsorted(a_fecha(desde or date.today()), side='left')
+        tramo = max(n * 4, 32)
+        while True:
+            candidatas = vista.iloc[inicio:inicio + tramo]
+            encontradas = candidatas[candidatas['estado'].isin(estados)]
+            if len(encontradas) >= n or inicio + tramo >= len(vista):
+                return encontradas.head(n)
+            tramo *= 4
+
+    # Clientes que coinciden con el texto (nombre, email, teléfono o placa),
+    # en orden de relevancia. Mientras el índice se construye solo espera
+    # quien busca: el lock del almacén queda libre para el resto.
+    def buscar_clientes(self, texto, limite=50):
+        with self._lock:
+            self._tabla_memoria('clientes')
+            self._tabla_memoria('vehiculos')
+            indice = self.indice_busqueda
+        try:
+            ids = indice.buscar(texto, limite)
+        except Exception:
+            self._reconstruir_indice(indice)
+            raise
+        with self._lock:
+            memoria = self._tabla_memoria('clientes')
+            posiciones = [memoria.posicion(cliente_id) for cliente_id in ids]
+            return memoria.frame().iloc[[pos for pos in posiciones if pos is not None]]
+
+    # Un índice al que le falló un cambio se sustituye por uno nuevo cargado
+    # desde las tablas en memoria; las búsquedas siguientes esperan a ese
+    def _reconstruir_indice(self, fallido):
+        with self._lock:
+            if self.indice_busqueda is not fallido:
+                return
+            self._observadores.remove(fallido)
+            self.indice_busqueda = IndiceBusqueda()
+            self.registrar(self.indice_busqueda)
+
+    # Búsqueda O(1) por clave única; devuelve la fila o None
+    def buscar(self, tabla, valor, columna='id'):
+        with self._lock:
+            memoria = self._tabla_memoria(tabla)
+            pos = memoria.posicion(valor, columna)
+            return None if pos is None else memoria.frame().iloc[pos]
+
+    # Filas que comparten una clave foránea (p. ej. vehículos de un cliente)
+    def filas_por(self, tabla, columna, valor):
+        with self._lock:
+            memoria = self._tabla_memoria(tabla)
+            return memoria.frame().iloc[memoria.posiciones(columna, valor)]
+
+    # Id nuevo para una tabla; se salta cualquiera que ya exista (p. ej.
+    # importado a mano dentro de un bloque ya reservado)
+    def nuevo_id(self, tabla):
+        with self._lock:
+            memoria = self._tabla_memoria(tabla)
+            while True:
+                id_registro = self.ids.nuevo(tabla)
+                if memoria.posicion(id_registro) is None:
+                    return id_registro
+
+    def insertar(self, tabla, registro):
+        self.insertar_varios(tabla, [registro])
+
+    # Alta en bloque: una transacción en SQLite y un solo anexo en memoria
+    def insertar_varios(self, tabla, registros):
+        with self._lock:
+            with self._escritura() as con:
+                nuevas = self._escribir_altas(con, tabla, registros)
+            self._aplicar_altas(tabla, nuevas)
+
+    # La tabla se carga antes de escribir para no leer las altas dos veces
+    def _escribir_altas(self, con, tabla, registros):
+        self._tabla_memoria(tabla)
+        nuevas = [normalizar_registro(tabla, r) for r in registros]
+        con.executemany(self._sql_insert[tabla],
+                        [tuple(_a_sql(v) for v in r.values()) for r in nuevas])
+        if tabla == 'citas':
+            self._anotar_eventos(con, [(r['id'], None, r['estado']) for r in nuevas])
+        self._anotar(con, tabla, [r['id'] for r in nuevas])
+        return nuevas
+
+    # Altas ya confirmadas en SQLite: se anexan en memoria y se notifican
+    def _aplicar_altas(self, tabla, nuevas):
+        self._tabla_memoria(tabla).anexar([tuple(r.values()) for r in nuevas])
+        self._versiones[tabla] = self.version(tabla) + 1
+        for observador in self._observadores:
+            observador.insertar(tabla, nuevas)
+
+    def actualizar(self, tabla, id_registro, **campos):
+        self._actualizar(tabla, id_registro, campos)
+
+    # Escritura con concurrencia optimista: solo se aplica si la fila sigue
+    # en la versión que leyó quien la edita; si no, ConflictoConcurrencia
+    def actualizar_versionado(self, tabla, id_registro, version_leida, **campos):
+        self._actualizar(tabla, id_registro, campos, int(version_leida))
+
+    # UPDATE de una fila por id. En las tablas con columna 'version' cada
+    # escritura la incrementa en SQLite y se lee de vuelta con RETURNING.
+    def _actualizar(self, tabla, id_registro, campos, version_leida=None):
+        if tabla == 'citas' and 'estado' in campos:
+            raise ValueError('El estado de una cita se cambia con cambiar_estados')
+        nuevos = {c: v for c, v in normalizar_registro(tabla, campos).items() if c in campos}
+        asignaciones = [f'"{c}" = ?' for c in nuevos]
+        parametros = [_a_sql(v) for v in nuevos.values()] + [id_registro]
+        condicion = 'id = ?'
+        versionada = 'version' in columnas(tabla)
+        if versionada:
+            asignaciones.append('version = version + 1')
+            if version_leida is not None:
+                condicion += ' AND version = ?'
+                parametros.append(version_leida)
+        sql = f'UPDATE "{tabla}" SET {", ".join(asignaciones)} WHERE {condicion}'
+        if versionada:
+            sql += ' RETURNING version'
+        with self._lock:
+            with self._escritura() as con:
+                self._tabla_memoria(tabla)
+                escrita = con.execute(sql, parametros).fetchone()
+                if escrita is not None or not versionada:
+                    self._anotar(con, tabla, [id_registro])
+            if versionada:
+                if escrita is None:
+                    if version_leida is not None:
+                        raise ConflictoConcurrencia(
+                            f'{id_registro} cambió desde que se leyó; vuelva a cargar los datos')
+                    return
+                nuevos['version'] = escrita[0]
+            self._reflejar(tabla, id_registro, nuevos)
+            self._versiones[tabla] = self.version(tabla) + 1
+
+    # Cambio ya escrito en SQLite: se aplica en memoria y se notifica
+    def _reflejar(self, tabla, id_registro, nuevos):
+        anterior = self._tabla_memoria(tabla).actualizar(id_registro, nuevos)
+        if anterior is not None:
+            for observador in self._observadores:
+                observador.actualizar(tabla, anterior, nuevos)
+
+    @staticmethod
+    def _anotar_eventos(con, eventos):
+        momento = datetime.now().isoformat(timespec='seconds')
+        con.executemany('INSERT INTO eventos_cita (cita_id, desde, hacia, momento) VALUES (?, ?, ?, ?)',
+                        [(cita_id, desde, hacia, momento) for cita_id, desde, hacia in eventos])
+
+    # Citas (por id, O(1) con el índice) que pasan a `hacia`. Las que ya
+    # están en ese estado o no existen se omiten; si alguna no puede hacer
+    # la transición no se cambia ninguna, salvo con omitir_invalidas.
+    def _citas_en_transicion(self, ids_citas, hacia, omitir_invalidas=False):
+        memoria = self._tabla_memoria('citas')
+        citas = []
+        for id_cita in dict.fromkeys(ids_citas):
+            pos = memoria.posicion(id_cita)
+            if pos is None:
+                continue
+            cita = memoria.fila(pos)
+            if cita['estado'] == hacia:
+                continue
+            if not transicion_valida(cita['estado'], hacia):
+                if omitir_invalidas:
+                    continue
+                raise TransicionInvalida(f"La cita {id_cita} no puede pasar de {cita['estado']} a {hacia}")
+            citas.append(cita)
+        return citas
+
+    # Anota un evento por cita y actualiza la proyección en la misma
+    # transacción. La condición sobre el estado anterior detecta que otro
+    # proceso la cambió primero.
+    def _escribir_transiciones(self, con, citas, hacia):
+        cambiadas = con.executemany('UPDATE citas SET estado = ? WHERE id = ? AND estado = ?',
+                                    [(hacia, cita['id'], cita['estado']) for cita in citas]).rowcount
+        if cambiadas != len(citas):
+            raise ConflictoConcurrencia('Alguna de las citas cambió desde que se leyó; vuelva a cargar los datos')
+        self._anotar_eventos(con, [(cita['id'], cita['estado'], hacia) for cita in citas])
+        self._anotar(con, 'citas', [cita['id'] for cita in citas])
+
+    def _reflejar_transiciones(self, citas, hacia):
+        self._reflejar_varios('citas', [cita['id'] for cita in citas], {'estado': hacia})
+
+    # Cambios ya escritos en SQLite sobre varias filas: una asignación por
+    # columna en memoria, una notificación por fila y una sola versión
+    def _reflejar_varios(self, tabla, ids, campos):
+        if not ids:
+            return
+        anteriores = self._tabla_memoria(tabla).actualizar_varios(ids, campos)
+        for i, anterior in enumerate(anteriores):
+            nuevos = {c: v[i] if isinstance(v, list) else v for c, v in campos.items()}
+            for observador in self._observadores:
+                observador.actualizar(tabla, anterior, nuevos)
+        self._versiones[tabla] = self.version(tabla) + 1
+
+    # Lleva varias citas a un estado en una transacción; completar pasa por
+    # completar_citas para descontar materiales. Devuelve los ids cambiados.
+    def cambiar_estados(self, ids_citas, estado, omitir_invalidas=False):
+        hacia = EstadoCita(estado)
+        if hacia == EstadoCita.COMPLETADA:
+            return self.completar_citas(ids_citas, omitir_invalidas)[0]
+        with self._lock:
+            with self._escritura() as con:
+                citas = self._citas_en_transicion(ids_citas, hacia.value, omitir_invalidas)
+                self._escribir_transiciones(con, citas, hacia.value)
+            self._reflejar_transiciones(citas, hacia.value)
+            return [cita['id'] for cita in citas]
+
+    def cambiar_estado(self, id_cita, estado):
+        return self.cambiar_estados([id_cita], estado)
+
+    # Completa varias citas en una transacción y descuenta de una vez los
+    # materiales de todos sus servicios: una sentencia por item, con la
+    # resta hecha en SQLite para que otra terminal no pierda unidades. Si a
+    # algún item no le alcanzan las unidades no se completa ninguna cita
+    # (StockInsuficiente) y el inventario queda como estaba.
+    # Devuelve los ids completados y las unidades descontadas por item.
+    def completar_citas(self, ids_citas, omitir_invalidas=False):
+        completada = EstadoCita.COMPLETADA.value
+        with self._lock:
+            with self._escritura() as con:
+                citas = self._citas_en_transicion(ids_citas, completada, omitir_invalidas)
+                self._tabla_memoria('inventario')
+                if not citas:
+                    return [], Counter()
+                consumo = self.catalogo.consumo(cita['servicio'] for cita in citas)
+
+                self._escribir_transiciones(con, citas, completada)
+                existencias, faltantes = [], []
+                for item_id, cantidad in consumo.items():
+                    fila = con.execute('UPDATE inventario SET stock = stock - ?, version = version + 1 '
+                                       'WHERE id = ? AND stock >= ? RETURNING id, stock, version',
+                                       (cantidad, item_id, cantidad)).fetchone()
+                    if fila is not None:
+                        existencias.append(fila)
+                    else:
+                        disponible = con.execute('SELECT item, stock FROM inventario WHERE id = ?',
+                                                 (item_id,)).fetchone()
+                        if disponible is not None:
+                            faltantes.append(f'{disponible[0]} (hay {disponible[1]}, se necesitan {cantidad})')
+                if faltantes:
+                    # La excepción deshace también el cambio de estado
+                    raise StockInsuficiente(f"Stock insuficiente: {', '.join(faltantes)}")
+                self._anotar(con, 'inventario', [fila[0] for fila in existencias])
+
+            self._reflejar_transiciones(citas, completada)
+            for item_id, stock, version in existencias:
+                self._reflejar('inventario', item_id, {'stock': stock, 'version': version})
+            if existencias:
+                self._versiones['inventario'] = self.version('inventario') + 1
+            return [cita['id'] for cita in citas], consumo
+
+    # Mueve varias citas a otra fecha (y hora, o cada una con la suya) en
+    # una transacción, solo si caben todas en la agenda; las finalizadas
+    # no se pueden mover. Devuelve los ids reprogramados.
+    def reprogramar_citas(self, ids_citas, fecha, hora=None):
+        fecha = a_fecha(fecha)
+        with self._lock:
+            with self._escritura() as con:
+                memoria = self._tabla_memoria('citas')
+                agenda = self.agenda()
+                citas = [memoria.fila(pos) for pos in (memoria.posicion(i) for i in dict.fromkeys(ids_citas))
+                         if pos is not None]
+                finalizadas = [cita['id'] for cita in citas if cita['estado'] in ESTADOS_FINALES]
+                if finalizadas:
+                    raise TransicionInvalida(f"No se pueden reprogramar citas finalizadas: {', '.join(finalizadas)}")
+                nuevos = [{'fecha': fecha, 'hora': cita['hora'] if hora is None else a_hora(hora)}
+                          for cita in citas]
+                fuera = agenda.no_caben(citas, nuevos)
+                if fuera:
+                    raise HorarioNoDisponible(
+                        f"No hay bahías libres el {fecha:%d/%m/%Y} para: {', '.join(fuera)}")
+                con.executemany('UPDATE citas SET fecha = ?, hora = ? WHERE id = ?',
+                                [(_a_sql(n['fecha']), _a_sql(n['hora']), cita['id'])
+                                 for cita, n in zip(citas, nuevos)])
+                ids = [cita['id'] for cita in citas]
+                self._anotar(con, 'citas', ids)
+            self._reflejar_varios('citas', ids, {'fecha': fecha, 'hora': [n['hora'] for n in nuevos]})
+            return ids
+
+    # Eventos de estado posteriores a `desde` (su seq), en orden. Un
+    # consumidor externo guarda el último seq que procesó y pide solo lo
+    # nuevo, sin volver a recorrer las citas.
+    def eventos(self, desde=0, cita_id=None, limite=None):
+        sql = 'SELECT seq, cita_id, desde, hacia, momento FROM eventos_cita WHERE seq > ?'
+        parametros = [desde]
+        if cita_id is not None:
+            sql += ' AND cita_id = ?'
+            parametros.append(cita_id)
+        sql += ' ORDER BY seq'
+        if limite is not None:
+            sql += ' LIMIT ?'
+            parametros.append(limite)
+        with self.pool.conexion() as con:
+            return pd.read_sql_query(sql, con, params=parametros)
+
+    # Los n eventos más recientes, del último al primero
+    def ultimos_eventos(self, n=100):
+        with self.pool.conexion() as con:
+            return pd.read_sql_query('SELECT seq, cita_id, desde, hacia, momento FROM eventos_cita '
+                                     'ORDER BY seq DESC LIMIT ?', con, params=(n,))
+
+    # Rehace la columna estado desde el registro de eventos (también se
+    # hace al abrir la base). Devuelve cuántas citas se corrigieron.
+    def reproducir_eventos(self):
+        with self._lock:
+            with self._escritura() as con:
+                corregidas = con.execute(SQL_REPRODUCIR_ESTADOS).rowcount
+                if corregidas:
+                    self._anotar(con, 'citas')
+            if corregidas:
+                self._recargar()
+            return corregidas
+
+    # Altas masivas: los observadores que saben procesar un bloque entero
+    # lo reciben como DataFrame; al resto se le pasan las filas una a una
+    def _notificar_bloque(self, tabla, frame):
+        for observador in self._observadores:
+            if hasattr(observador, 'insertar_bloque'):
+                observador.insertar_bloque(tabla, frame)
+            else:
+                observador.insertar(tabla, frame.to_dict('records'))
+
+    # Resuelve las claves foráneas que faltan a partir de claves naturales
+    # ('email' del cliente en vehículos y 'placa' del vehículo en citas) con
+    # el índice de la tabla en memoria; si la clave se repite gana la
+    # primera fila
+    def _resolver_referencias(self, tabla, bloque):
+        if tabla == 'vehiculos' and 'email' in bloque:
+            padre, natural, resolver = 'clientes', 'email', {'cliente_id': 'id'}
+        elif tabla == 'citas' and 'placa' in bloque:
+            padre, natural, resolver = 'vehiculos', 'placa', {'vehiculo_id': 'id', 'cliente_id': 'cliente_id'}
+        else:
+            return bloque
+        memoria = self._tabla_memoria(padre)
+        _, normalizar = CLAVES_DEDUPLICADO[padre]
+        posiciones = np.array([(memoria.posiciones(natural, clave) or [-1])[0]
+                               for clave in normalizar(bloque[natural]).tolist()], dtype=np.int64)
+        encontradas = posiciones >= 0
+        for columna, origen in resolver.items():
+            valores = memoria.frame()[origen].to_numpy(dtype=object)[posiciones]
+            valores = pd.Series(np.where(encontradas, valores, None), index=bloque.index)
+            bloque[columna] = bloque[columna].fillna(valores) if columna in bloque else valores
+        return bloque
+
+    # Valida y tipa un bloque leído. Se descartan las filas sin campos
+    # obligatorios o con valores que no se pueden convertir (una fecha
+    # ilegible, un estado desconocido), las que repiten id o clave natural
+    # (contra la tabla y contra bloques anteriores, acumulados en `vistos`)
+    # y las que apuntan a un cliente o vehículo inexistente. Las columnas
+    # de texto se convierten al final, con los ausentes ya descartados.
+    def _preparar_bloque(self, tabla, bloque, vistos, resumen, con):
+        bloque = self._resolver_referencias(tabla, bloque.rename(columns=str.strip))
+        for columna in columnas(tabla):
+            if columna not in bloque:
+                bloque[columna] = None
+        # Las filas sin id reciben un bloque de ids de la secuencia
+        sin_id = bloque['id'].isna().to_numpy()
+        if sin_id.any():
+            bloque['id'] = bloque['id'].astype(object)
+            bloque.loc[sin_id, 'id'] = self.ids.reservar(tabla, int(sin_id.sum()), con)
+        invalidas = np.zeros(len(bloque), bool)
+        bloque = aplicar_esquema(tabla, bloque[columnas(tabla)], invalidas)
+        invalidas |= bloque[OBLIGATORIAS[tabla]].isna().any(axis=1).to_numpy()
+        resumen['invalidas'] += int(invalidas.sum())
+        bloque = bloque[~invalidas]
+
+        repetidas = (self._tabla_memoria(tabla).contiene(bloque['id']) | en_claves(bloque['id'], vistos['id'])
+                     | bloque['id'].duplicated().to_numpy())
+        if tabla in CLAVES_DEDUPLICADO:
+            columna, normalizar = CLAVES_DEDUPLICADO[tabla]
+            claves = normalizar(bloque[columna])
+            repetidas |= (claves.notna() & (claves.duplicated() | en_claves(claves, vistos[columna]))).to_numpy()
+        resumen['duplicadas'] += int(repetidas.sum())
+        bloque = bloque[~repetidas]
+
+        referenciadas = np.ones(len(bloque), bool)
+        for columna, padre in REFERENCIAS.items():
+            if columna in bloque:
+                referenciadas &= self._tabla_memoria(padre).contiene(bloque[columna])
+        resumen['sin_referencia'] += int((~referenciadas).sum())
+        bloque = bloque[referenciadas].reset_index(drop=True)
+        for columna in columnas(tabla):
+            if columna not in TIPOS[tabla]:
+                bloque[columna] = bloque[columna].astype('str')
+
+        vistos['id'].update(bloque['id'].tolist())
+        if tabla in CLAVES_DEDUPLICADO:
+            columna, normalizar = CLAVES_DEDUPLICADO[tabla]
+            vistos[columna].update(normalizar(bloque[columna]).dropna())
+        return bloque
+
+    # Si el primer bloque ya trae tantas filas como la tabla, sus índices
+    # secundarios de SQLite se quitan y se vuelven a crear al final, en la
+    # misma transacción: ordenar una vez sale más barato que insertar cada
+    # fila en un árbol ya grande (en citas, también los del registro de
+    # eventos, que recibe el alta de cada una). Devuelve las sentencias para
+    # recrearlos.
+    @staticmethod
+    def _quitar_indices(con, *tablas):
+        if not con.in_transaction:
+            con.execute('BEGIN')
+        indices = con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                              f"AND tbl_name IN ({', '.join('?' for _ in tablas)}) AND sql IS NOT NULL",
+                              tablas).fetchall()
+        for nombre, _ in indices:
+            con.execute(f'DROP INDEX "{nombre}"')
+        return [sql for _, sql in indices]
+
+    # Importación por bloques de un CSV o Parquet en una sola transacción:
+    # si algo falla no queda nada a medias ni en SQLite ni en memoria.
+    # `progreso` recibe el resumen acumulado tras cada bloque. Las claves
+    # foráneas ya se validan en _preparar_bloque, así que SQLite no las
+    # vuelve a revisar fila a fila (era la mayor parte del INSERT).
+    def importar(self, tabla, fuente, formato='csv', tamaño_bloque=TAMAÑO_BLOQUE, progreso=None):
+        resumen = {'leidas': 0, 'importadas': 0, 'invalidas': 0, 'duplicadas': 0, 'sin_referencia': 0}
+        with self._lock, self.perfilador.tramo(f'importar {tabla}'), recolector_pausado():
+            aceptados = []
+            with self._escritura(claves_foraneas=False) as con:
+                memoria = self._tabla_memoria(tabla)
+                vistos = {'id': set()}
+                if tabla in CLAVES_DEDUPLICADO:
+                    columna, _ = CLAVES_DEDUPLICADO[tabla]
+                    vistos[columna] = set(memoria.claves(columna))
+
+                # Las filas importadas quedan por encima del mayor rowid actual
+                ultima_fila = con.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM "{tabla}"').fetchone()[0]
+                indices = None
+                for bloque in leer_por_bloques(fuente, formato, tamaño_bloque):
+                    resumen['leidas'] += len(bloque)
+                    bloque = self._preparar_bloque(tabla, bloque, vistos, resumen, con)
+                    if len(bloque):
+                        if indices is None:
+                            tablas = (tabla, 'eventos_cita') if tabla == 'citas' else (tabla,)
+                            indices = self._quitar_indices(con, *tablas) if len(bloque) >= len(memoria) else []
+                        texto = a_texto_sql(tabla, bloque)
+                        con.executemany(self._sql_insert[tabla],
+                                        zip(*(texto[columna].tolist() for columna in texto.columns)))
+                        self.ids.respetar(con, tabla, bloque['id'])
+                        aceptados.append(bloque)
+                        resumen['importadas'] += len(bloque)
+                    if progreso is not None:
+                        progreso(resumen)
+                if aceptados and tabla == 'citas':
+                    # Evento de alta de cada cita importada, en una sola sentencia
+                    con.execute('INSERT INTO eventos_cita (cita_id, desde, hacia, momento) '
+                                'SELECT id, NULL, estado, ? FROM citas WHERE rowid > ?',
+                                (datetime.now().isoformat(timespec='seconds'), ultima_fila))
+                for sql in indices or []:
+                    con.execute(sql)
+                if aceptados:
+                    self._anotar(con, tabla)
+
+            for bloque in aceptados:
+                memoria.anexar_frame(bloque)
+                self._notificar_bloque(tabla, bloque)
+            if aceptados:
+                self._versiones[tabla] = self.version(tabla) + 1
+        return resumen
+
+    # Exportación por bloques con el mismo formato de texto que SQLite, de
+    # modo que el archivo se puede volver a importar; devuelve las filas
+    def exportar(self, tabla, destino, formato='csv', tamaño_bloque=TAMAÑO_BLOQUE):
+        frame = self.tabla(tabla)
+        inicios = range(0, max(len(frame), 1), tamaño_bloque)
+        if formato == 'csv':
+            for inicio in inicios:
+                a_texto_sql(tabla, frame.iloc[inicio:inicio + tamaño_bloque]).to_csv(
+                    destino, index=False, header=inicio == 0, mode='w' if inicio == 0 else 'a')
+        elif formato == 'parquet':
+            pa, pq = _parquet()
+            tipos = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+            esquema = pa.schema([(nombre, tipos.get(tipo.split()[0], pa.string()))
+                                 for nombre, tipo in ESQUEMAS[tabla]])
+            with pq.ParquetWriter(destino, esquema) as escritor:
+                for inicio in inicios:
+                    bloque = a_texto_sql(tabla, frame.iloc[inicio:inicio + tamaño_bloque])
+                    escritor.write_table(pa.Table.from_pandas(bloque, schema=esquema, preserve_index=False))
+        else:
+            raise ValueError(f'Formato no soportado: {formato}')
+        return len(frame)
@@ -0,0 +1,391 @@
+# Banco de pruebas de rendimiento de AutoTaller Pro
+#
+# Genera un conjunto de datos sintético reproducible (semilla fija), lo
+# importa en una base nueva y recorre las páginas de taller_app.py sin
+# navegador con el AppTest de Streamlit, midiendo cada escenario y la
+# memoria del proceso. El resultado se guarda en JSON para compararlo con
+# una ejecución anterior:
+#
+#   python taller_rendimiento.py --escala 100000 --salida base.json
+#   python taller_rendimiento.py --escala 100000 --comparar base.json
+#
+# La escala es el número de citas; clientes, vehículos e items de
+# inventario se derivan de ella (de 10k a 1M filas por tabla).
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taller_app.py')
+
+NOMBRES = ['Juan', 'María', 'Carlos', 'Ana', 'Luis', 'Laura', 'Jorge', 'Sofía', 'Andrés', 'Camila',
+           'Pedro', 'Valentina', 'Diego', 'Daniela', 'Miguel', 'Paula', 'José', 'Lucía', 'Felipe', 'Sara']
+APELLIDOS = ['Pérez', 'García', 'Rodríguez', 'López', 'Martínez', 'González', 'Hernández', 'Sánchez',
+             'Ramírez', 'Torres', 'Flores', 'Rivera', 'Gómez', 'Díaz', 'Vargas', 'Castro', 'Rojas',
+             'Morales', 'Ortiz', 'Herrera']
+MODELOS = {
+    'Toyota': ['Corolla', 'Hilux', 'Yaris', 'RAV4'],
+    'Chevrolet': ['Spark', 'Onix', 'Tracker', 'Sail'],
+    'Renault': ['Logan', 'Sandero', 'Duster', 'Kwid'],
+    'Mazda': ['2', '3', 'CX-5', 'CX-30'],
+    'Nissan': ['Versa', 'Sentra', 'Kicks', 'Frontier'],
+    'Honda': ['Civic', 'CR-V', 'HR-V', 'Fit'],
+    'Kia': ['Picanto', 'Rio', 'Sportage', 'Seltos'],
+}
+MATERIALES = ['Aceite motor', 'Filtro aire', 'Filtro aceite', 'Pastillas freno', 'Bujías',
+              'Líquido frenos', 'Refrigerante', 'Correa distribución', 'Batería', 'Plumillas']
+PROVEEDORES = ['Lubricantes S.A.', 'Filtros Pro', 'Frenos Total', 'Bujías Max', 'Repuestos Andinos']
+LETRAS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), dtype=object)
+
+DIAS_HISTORIA = 3 * 365
+DIAS_FUTUROS = 60
+# Ocupación de la agenda en los próximos días: deja huecos para reservar
+OCUPACION_FUTURA = 0.5
+
+
+def tamaños(escala):
+    return {
+        'clientes': max(escala // 5, 10),
+        'vehiculos': max(escala // 4, 10),
+        'citas': escala,
+        'inventario': max(escala // 1000, 20),
+    }
+
+
+# Elige textos de una lista con índices aleatorios, como array de objetos
+def _elegir(rng, opciones, n, p=None):
+    return np.array(opciones, dtype=object)[rng.choice(len(opciones), n, p=p)]
+
+
+def _ids(tabla, n):
+    from taller_datos import formato_id
+    return np.array([formato_id(tabla, numero) for numero in range(1, n + 1)], dtype=object)
+
+
+def _fechas(hoy, desplazamientos):
+    return pd.Series(pd.Timestamp(hoy) + pd.to_timedelta(desplazamientos, unit='D')).dt.strftime('%Y-%m-%d')
+
+
+# Tablas en el formato de importación (texto, como en SQLite) generadas de
+# forma vectorizada a partir de la semilla
+def generar_datos(escala, semilla=42, hoy=None):
+    from taller_datos import BAHIAS, HORARIOS_CITA, SERVICIOS_INICIALES, EstadoCita
+    rng = np.random.default_rng(semilla)
+    hoy = hoy or date.today()
+    n = tamaños(escala)
+
+    nombres = _elegir(rng, NOMBRES, n['clientes'])
+    apellidos = _elegir(rng, APELLIDOS, n['clientes'])
+    ids_clientes = _ids('clientes', n['clientes'])
+    clientes = pd.DataFrame({
+        'id': ids_clientes,
+        'nombre': nombres + ' ' + apellidos + ' ' + _elegir(rng, APELLIDOS, n['clientes']),
+        'telefono': pd.Series(rng.integers(300_000_000, 399_999_999, n['clientes'])).astype(str).to_numpy(),
+        'email': (pd.Series(nombres).str.lower() + '.' + pd.Series(ids_clientes).str.lower()
+                  + '@correo.com').to_numpy(),
+        'fecha_registro': _fechas(hoy, -rng.integers(0, 5 * 365, n['clientes'])),
+    })
+
+    # Placas únicas a partir del índice: dos letras y cuatro dígitos, un
+    # formato que no coincide con las placas de los datos de ejemplo (tres
+    # letras y tres dígitos) y alcanza para 6,7 millones de vehículos
+    indices = np.arange(n['vehiculos'])
+    bloque = indices // 10_000
+    placas = (LETRAS[bloque // 26 % 26] + LETRAS[bloque % 26]
+              + pd.Series(indices % 10_000).astype(str).str.zfill(4).to_numpy())
+    marcas = _elegir(rng, list(MODELOS), n['vehiculos'])
+    modelos = np.array([MODELOS[marca][k] for marca, k in zip(marcas, rng.integers(0, 4, n['vehiculos']))],
+                       dtype=object)
+    vehiculos = pd.DataFrame({
+        'id': _ids('vehiculos', n['vehiculos']),
+        'cliente_id': ids_clientes[rng.integers(0, n['clientes'], n['vehiculos'])],
+        'marca': marcas,
+        'modelo': modelos,
+        'año': rng.integers(1995, 2025, n['vehiculos']),
+        'placa': placas,
+    })
+
+    # Las citas futuras ocupan como mucho OCUPACION_FUTURA de la agenda; el
+    # resto es historia de los últimos DIAS_HISTORIA días
+    futuras = min(n['citas'] // 10, int(DIAS_FUTUROS * len(HORARIOS_CITA) * BAHIAS * OCUPACION_FUTURA))
+    pasadas = n['citas'] - futuras
+    desplazamientos = np.concatenate([-rng.integers(1, DIAS_HISTORIA, pasadas),
+                                      rng.integers(1, DIAS_FUTUROS, futuras)])
+    estados = np.concatenate([
+        _elegir(rng, [EstadoCita.COMPLETADA.value, EstadoCita.CANCELADA.value, EstadoCita.PENDIENTE.value],
+                pasadas, p=[0.8, 0.15, 0.05]),
+        _elegir(rng, [EstadoCita.PENDIENTE.value, EstadoCita.CONFIRMADA.value, EstadoCita.CANCELADA.value],
+                futuras, p=[0.5, 0.45, 0.05]),
+    ])
+    indice_servicio = rng.choice(len(SERVICIOS_INICIALES), n['citas'], p=[0.35, 0.15, 0.15, 0.1, 0.1, 0.15])
+    indice_vehiculo = rng.integers(0, n['vehiculos'], n['citas'])
+    citas = pd.DataFrame({
+        'id': _ids('citas', n['citas']),
+        'cliente_id': vehiculos['cliente_id'].to_numpy()[indice_vehiculo],
+        'vehiculo_id': vehiculos['id'].to_numpy()[indice_vehiculo],
+        'servicio': np.array([s['nombre'] for s in SERVICIOS_INICIALES], dtype=object)[indice_servicio],
+        'fecha': _fechas(hoy, desplazamientos),
+        'hora': _elegir(rng, HORARIOS_CITA, n['citas']),
+        'estado': estados,
+        'precio': np.array([s['precio'] for s in SERVICIOS_INICIALES])[indice_servicio],
+    })
+
+    stock_minimo = rng.integers(5, 21, n['inventario'])
+    inventario = pd.DataFrame({
+        'id': _ids('inventario', n['inventario']),
+        'item': (_elegir(rng, MATERIALES, n['inventario']) + ' '
+                 + pd.Series(np.arange(1, n['inventario'] + 1)).astype(str).str.zfill(4).to_numpy()),
+        'stock': stock_minimo + rng.integers(-5, 60, n['inventario']).clip(-stock_minimo),
+        'stock_minimo': stock_minimo,
+        'precio': rng.integers(5, 300, n['inventario']) * 1000,
+        'proveedor': _elegir(rng, PROVEEDORES, n['inventario']),
+        'version': 0,
+    })
+    return {'clientes': clientes, 'vehiculos': vehiculos, 'citas': citas, 'inventario': inventario}
+
+
+# Importa las tablas por el mismo camino que el panel de datos (CSV por
+# bloques); devuelve los segundos de cada tabla
+def poblar(ruta, datos):
+    from taller_datos import AlmacenTaller
+    almacen = AlmacenTaller(ruta)
+    segundos = {}
+    for tabla, frame in datos.items():
+        inicio = time.perf_counter()
+        resumen = almacen.importar(tabla, io.StringIO(frame.to_csv(index=False)), 'csv')
+        segundos[tabla] = round(time.perf_counter() - inicio, 3)
+        if resumen['importadas'] != len(frame):
+            raise RuntimeError(f'{tabla}: solo se importaron {resumen["importadas"]} de {len(frame)} filas')
+    return segundos
+
+
+# Memoria residente actual del proceso en MB (pico si no hay /proc)
+def memoria_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memoria_pico_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class FalloEscenario(Exception):
+    pass
+
+
+# Sesión nueva de la aplicación en una página
+def sesion(pagina, autenticado=False, timeout=600):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(RUTA_APP, default_timeout=timeout)
+    at.session_state.page = pagina
+    at.session_state.authenticated = autenticado
+    return at
+
+
+# Ejecuta la sesión (o la interacción con un widget) y falla si la página lanzó
+def _ejecutar(objeto):
+    at = objeto.run()
+    if at.exception:
+        raise FalloEscenario(at.exception[0].message)
+    return at
+
+
+def _por_etiqueta(elementos, etiqueta):
+    return next(e for e in elementos if e.label == etiqueta)
+
+
+# Cada escenario prepara su sesión y devuelve la acción a cronometrar; la
+# repetición i recibe su propio índice para variar fechas y búsquedas
+def escenario_pagina(pagina, autenticado=False):
+    def preparar(i, contexto):
+        at = sesion(pagina, autenticado)
+        return lambda: _ejecutar(at)
+    return preparar
+
+
+def escenario_reserva(i, contexto):
+    at = _ejecutar(sesion('citas'))
+    dia = date.today() + timedelta(days=1 + i % (DIAS_FUTUROS - 1))
+    while dia.weekday() == 6:
+        dia += timedelta(days=1)
+    _ejecutar(_por_etiqueta(at.date_input, 'Fecha de la cita').set_value(dia))
+    return lambda: _ejecutar(_por_etiqueta(at.button, 'Confirmar Cita').click())
+
+
+def escenario_busqueda(i, contexto):
+    at = _ejecutar(sesion('citas'))
+    texto = contexto['busquedas'][i % len(contexto['busquedas'])]
+    return lambda: _ejecutar(_por_etiqueta(at.text_input, 'Buscar por nombre, teléfono, email o placa').input(texto))
+
+
+def escenario_filtro_citas(i, contexto):
+    from taller_datos import ESTADOS
+    at = _ejecutar(sesion('citas'))
+    return lambda: _ejecutar(_por_etiqueta(at.selectbox, 'Filtrar por estado').select(ESTADOS[i % len(ESTADOS)]))
+
+
+def escenario_reporte(reporte):
+    def preparar(i, contexto):
+        at = _ejecutar(sesion('admin', autenticado=True))
+        return lambda: _ejecutar(_por_etiqueta(at.selectbox, 'Tipo de reporte').select(reporte))
+    return preparar
+
+
+ESCENARIOS = {
+    'inicio': escenario_pagina('inicio'),
+    'reserva': escenario_reserva,
+    'busqueda': escenario_busqueda,
+    'mis_citas_filtro': escenario_filtro_citas,
+    'inventario': escenario_pagina('inventario'),
+    'admin': escenario_pagina('admin', autenticado=True),
+    'reporte_servicios': escenario_reporte('Servicios Más Solicitados'),
+    'reporte_clientes': escenario_reporte('Clientes Frecuentes'),
+}
+
+
+def medir_escenario(preparar, repeticiones, contexto):
+    tiempos = []
+    for i in range(repeticiones):
+        accion = preparar(i, contexto)
+        inicio = time.perf_counter()
+        accion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    tiempos = np.array(tiempos)
+    return {
+        'repeticiones': repeticiones,
+        'mediana_ms': round(float(np.median(tiempos)), 2),
+        'p95_ms': round(float(np.quantile(tiempos, 0.95)), 2),
+        'min_ms': round(float(tiempos.min()), 2),
+        'max_ms': round(float(tiempos.max()), 2),
+        'memoria_mb': round(memoria_mb(), 1),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(RUTA_APP), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def ejecutar(escala, semilla, repeticiones, escenarios, ruta_db=None):
+    # La aplicación abre la base por TALLER_DB y mide sus tramos; ambas
+    # variables tienen que estar antes de importar taller_datos
+    ruta_db = ruta_db or os.path.join(tempfile.mkdtemp(prefix='taller_rendimiento_'), 'taller.db')
+    os.environ['TALLER_DB'] = ruta_db
+    os.environ['TALLER_PERFILADO'] = '1'
+    # Sin contexto de script, Streamlit avisa en cada acceso a la caché
+    logging.disable(logging.WARNING)
+    import streamlit as st
+    import taller_datos
+
+    resultado = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit(),
+        'semilla': semilla,
+        'escala': escala,
+        'tamaños': tamaños(escala),
+        'entorno': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'streamlit': st.__version__,
+            'plataforma': platform.platform(),
+        },
+    }
+
+    inicio = time.perf_counter()
+    datos = generar_datos(escala, semilla)
+    resultado['generacion_s'] = round(time.perf_counter() - inicio, 3)
+    resultado['importacion_s'] = poblar(ruta_db, datos)
+    contexto = {
+        'busquedas': pd.concat([datos['clientes']['nombre'].str.split().str[0],
+                                datos['vehiculos']['placa'],
+                                datos['clientes']['telefono'].str[:6]])
+        .sample(n=max(repeticiones, 1), random_state=semilla).tolist()
+    }
+    del datos
+
+    # Primera ejecución: carga las tablas desde SQLite en el almacén del proceso
+    memoria_inicial = memoria_mb()
+    inicio = time.perf_counter()
+    _ejecutar(sesion('inicio'))
+    resultado['arranque'] = {'ms': round((time.perf_counter() - inicio) * 1000, 2),
+                             'memoria_mb': round(memoria_mb() - memoria_inicial, 1)}
+
+    perfilador = taller_datos.PERFILADOR
+    perfilador.reiniciar()
+    resultado['escenarios'] = {}
+    for nombre in escenarios:
+        print(f'  {nombre}...', file=sys.stderr, flush=True)
+        resultado['escenarios'][nombre] = medir_escenario(ESCENARIOS[nombre], repeticiones, contexto)
+    resultado['memoria_pico_mb'] = round(memoria_pico_mb(), 1)
+    resultado['tramos'] = perfilador.resumen().head(40).round(3).to_dict('records')
+    return resultado
+
+
+# Escenarios más lentos o con más memoria que la base por encima de la
+# tolerancia (y de un mínimo absoluto, para no reportar ruido)
+def comparar(resultado, base, tolerancia=0.25, minimo_ms=5.0):
+    regresiones = []
+    for nombre, actual in resultado['escenarios'].items():
+        anterior = base.get('escenarios', {}).get(nombre)
+        if anterior is None:
+            continue
+        for medida, minimo in (('mediana_ms', minimo_ms), ('memoria_mb', 10.0)):
+            if actual[medida] > anterior[medida] * (1 + tolerancia) and actual[medida] - anterior[medida] > minimo:
+                regresiones.append(f'{nombre}: {medida} {anterior[medida]} -> {actual[medida]}')
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Banco de pruebas de rendimiento de AutoTaller Pro')
+    parser.add_argument('--escala', type=int, default=10_000, help='número de citas (por defecto 10000)')
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--escenarios', nargs='+', choices=list(ESCENARIOS), default=list(ESCENARIOS))
+    parser.add_argument('--db', help='ruta de la base a crear (por defecto, una temporal)')
+    parser.add_argument('--salida', help='archivo JSON donde guardar el resultado')
+    parser.add_argument('--comparar', help='JSON de una ejecución anterior para detectar regresiones')
+    parser.add_argument('--tolerancia', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    if args.db and os.path.exists(args.db):
+        parser.error(f'{args.db} ya existe; el banco necesita una base nueva')
+    resultado = ejecutar(args.escala, args.semilla, args.repeticiones, args.escenarios, args.db)
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2, default=str)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto)
+    else:
+        print(texto)
+
+    for nombre, medidas in resultado['escenarios'].items():
+        print(f'{nombre:20s} {medidas["mediana_ms"]:10.1f} ms  p95 {medidas["p95_ms"]:10.1f} ms',
+              file=sys.stderr)
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as archivo:
+            regresiones = comparar(resultado, json.load(archivo), args.tolerancia)
+        for regresion in regresiones:
+            print(f'REGRESIÓN {regresion}', file=sys.stderr)
+        return 1 if regresiones else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,27 @@
+# Pruebas del generador de datos del banco de rendimiento: a gran escala
+# todas las filas generadas deben importarse sin que se descarte ninguna
+
+from taller_datos import AlmacenTaller, _datos_semilla
+from taller_rendimiento import generar_datos, poblar
+
+# Por encima de ~112k citas las placas generadas llegaban a 'ABC123'
+ESCALA = 120_000
+
+
+def test_placas_no_chocan_con_los_datos_de_ejemplo():
+    vehiculos = generar_datos(ESCALA)['vehiculos']
+    placas = set(vehiculos['placa'])
+    semilla = {fila[-1] for fila in _datos_semilla()['vehiculos']}
+    assert len(placas) == len(vehiculos)
+    assert not placas & semilla
+
+
+def test_poblar_a_gran_escala(tmp_path):
+    datos = generar_datos(ESCALA)
+    assert sum(len(frame) for frame in datos.values()) >= 150_000
+    ruta = str(tmp_path / 'taller.db')
+    poblar(ruta, datos)
+    almacen = AlmacenTaller(ruta)
+    semilla = _datos_semilla()
+    for tabla, frame in datos.items():
+        assert almacen.contar(tabla) == len(frame) + len(semilla[tabla])